@@ -1,14 +1,14 @@
-import random
-import math
 import numpy as np
 
-from config import *
+from generator_config import GeneratorConfig
+from kernels import direction_kernel, resolve_backend, rotation, straight_move_kernel
+from random_stream import random_stream
 from util import *
 
 class Walker:
     def __init__(
             self, 
-            grid,
+            canvas,
             grid_size, 
             tortuous, 
             reproduction_probability, 
@@ -17,18 +17,36 @@ class Walker:
             initial_direction = None,
             width = None,
             moves = 0,
-            max_moves = MAX_MOVES
+            max_moves = None,
+            vector_field = None,
+            rng = None,
+            depth = 0,
+            stats = None,
+            config = None,
+            geometry = None,
+            parent_id = -1,
+            random = None
         ):
+        # Parameters of the generator, shared by the walker and its children
+        self.config = config if config is not None else GeneratorConfig()
+        self.compiled = resolve_backend(self.config.compute_backend) == "numba"
+        # Every random draw of the walker and its children goes through this generator
+        self.rng = rng if rng is not None else np.random.default_rng()
+        # Random decisions of the moves (random_stream.DirectRandom or BufferedRandom), shared with the children
+        self.random = random if random is not None else random_stream(self.rng, grid_size, self.config)
+
         # Choose a random position on the SIZE x SIZE grid
         if initial_point is None:
-            self.x = random.randint(0, grid_size - 1)
-            self.y = random.randint(0, grid_size - 1)
+            self.x = self.rng.integers(0, grid_size)
+            self.y = self.rng.integers(0, grid_size)
         else:
             self.x, self.y = initial_point
         self.source_point = source_point        
+        # Tabulated vector field shared by all the walkers of an image, None to compute the exact field
+        self.vector_field = vector_field
 
         self.grid_size = grid_size
-        self.grid = grid
+        self.canvas = canvas
         self.reproduction_probability = reproduction_probability
 
         if initial_direction is not None:
@@ -37,13 +55,13 @@ class Walker:
             # Choose a random direction vector
             norm = 0.0
             while norm == 0.0:
-                dir_x = random.randint(-1, 1)
-                dir_y = random.randint(-1, 1)
+                dir_x = self.rng.integers(-1, 2)
+                dir_y = self.rng.integers(-1, 2)
                 norm = np.sqrt(dir_x ** 2 + dir_y ** 2)
             self.direction = (dir_x/norm , dir_y/norm)
 
         if width is None:
-            self.width = self.grid_size * WALKER_INITIAL_PATH_WIDTH
+            self.width = self.grid_size * self.config.walker_initial_path_width
         else:
             self.width = width
 
@@ -56,10 +74,28 @@ class Walker:
         self.children = []
 
         self.moves = moves
-        self.max_moves = max_moves
+        self.max_moves = max_moves if max_moves is not None else self.config.max_moves
+
+        # Generation of the walker in the tree (0 for the initial walkers)
+        self.depth = depth
+        # Optional stats.ImageStats counting the walkers and their moves
+        self.stats = stats
+        if stats is not None:
+            stats.walkers_born(1, depth)
+        # Optional geometry.GeometryRecorder recording the strokes of the walker and its children
+        self.geometry = geometry
+        if geometry is not None:
+            self.walker_id = geometry.add_walker(parent_id)
     
     def get_tortuous_points(self):
-        return self.tortuous_point_sets + sum([child.get_tortuous_points() for child in self.children], [])
+        # Iterative pre-order walk over the tree, concatenating the children's lists recursively is quadratic
+        point_sets = []
+        walkers = [self]
+        while walkers:
+            walker = walkers.pop()
+            point_sets.extend(walker.tortuous_point_sets)
+            walkers.extend(reversed(walker.children))
+        return point_sets
 
     def get_direction(self, point = None):
         """
@@ -67,27 +103,37 @@ class Walker:
         1. The current direction of the walker - to preserve the momentum
         2. The vector field direction - to guide the walker towards the sink
         3. The middle line direction - to encourage growth of walkers towards the middle of the image
-        The weights can be adjusted in the config file
+        The weights are set by the generator config
         """
         if point is None:
             point = (self.x, self.y)
+        if self.vector_field is not None:
+            return self.vector_field.direction(point, self.direction)
         x, y = point
 
         source_x, source_y = self.source_point
         sink_x, sink_y = (self.grid_size - source_x, self.grid_size - source_y)
 
+        # The field is undefined on the source and the sink, the reference code below handles them
+        if self.compiled and (x, y) != (source_x, source_y) and (x, y) != (sink_x, sink_y):
+            return direction_kernel(
+                float(x), float(y), float(self.direction[0]), float(self.direction[1]),
+                float(source_x), float(source_y), float(self.grid_size),
+                float(self.config.sink_strength), float(self.config.vector_field_weight), float(self.config.middle_line_weight)
+            )
+
         def E(q, r0, x, y):
             """Return the electric field vector E=(Ex,Ey) due to charge q at r0."""
 
             # If at source or sink, return a random vector
             if(r0[0] == x and r0[1] == y):
-                return random.random(), random.random()
+                return self.rng.random(), self.rng.random()
 
             den = np.hypot(x-r0[0], y-r0[1])**3
             return q * (x - r0[0]) / den, q * (y - r0[1]) / den
 
         ex, ey = E(1, (source_x, source_y), x, y)
-        ex_, ey_ = E(-1 * SINK_STRENGTH, (sink_x, sink_y), x, y)
+        ex_, ey_ = E(-1 * self.config.sink_strength, (sink_x, sink_y), x, y)
 
         vector_field_direction = normalize_vector((ex + ex_, ey + ey_))
 
@@ -98,8 +144,8 @@ class Walker:
 
         return normalize_vector(
             add_vectors([
-                (vector_field_direction, VECTOR_FIELD_WEIGHT),
-                (direction_towards_line, MIDDLE_LINE_WEIGHT),
+                (vector_field_direction, self.config.vector_field_weight),
+                (direction_towards_line, self.config.middle_line_weight),
                 (self.direction, None),
             ])
         )
@@ -113,7 +159,10 @@ class Walker:
         
         self.moves += 1
 
-        tortuous_move = self.tortuous and random.random() <= TORTUOUS_PROBABILITY
+        tortuous_move = self.tortuous and self.random.random() <= self.config.tortuous_probability
+        if self.stats is not None:
+            self.stats.total_moves += 1
+            self.stats.tortuous_segments += int(tortuous_move)
         if tortuous_move:
             tortuous_points = sum(
                 [
@@ -146,27 +195,35 @@ class Walker:
     
     def try_reproduce(self):
         # The walkers should have been alive for a while before they can reproduce
-        if self.moves < WALKER_MATURITY_STEPS:
+        if self.moves < self.config.walker_maturity_steps:
             return
         
         reproduction_prob = self.reproduction_probability
         # The tortuous walkers should be less likely to reproduce to prevent cluttering
         if self.tortuous:
-            reproduction_prob *= TORTUOUS_REPRODUCTION_PROBABILITY_MULTIPLIER
+            reproduction_prob *= self.config.tortuous_reproduction_probability_multiplier
         
-        if random.random() < reproduction_prob:
+        if self.random.random() < reproduction_prob:
             self.children.append(
                 Walker(
-                    grid = self.grid, 
+                    canvas = self.canvas, 
                     grid_size = self.grid_size, 
                     tortuous = self.tortuous,
-                    reproduction_probability = self.reproduction_probability * WALKER_CHILD_REPRODUCTION_PROBABILITY_MULTIPLIER,
+                    reproduction_probability = self.reproduction_probability * self.config.walker_child_reproduction_probability_multiplier,
                     initial_point = (self.x, self.y),
                     source_point = self.source_point,
                     initial_direction = rotate_vector(self.direction, self.get_random_large_angle()),
-                    width = self.width * WALKER_CHILD_PATH_WIDTH_MULTIPLIER,
+                    width = self.width * self.config.walker_child_path_width_multiplier,
                     moves = self.moves,
-                    max_moves = self.max_moves * WALKER_CHILD_MAX_MOVES_MULTIPLIER
+                    max_moves = self.max_moves * self.config.walker_child_max_moves_multiplier,
+                    vector_field = self.vector_field,
+                    rng = self.rng,
+                    depth = self.depth + 1,
+                    stats = self.stats,
+                    config = self.config,
+                    geometry = self.geometry,
+                    parent_id = self.walker_id if self.geometry is not None else -1,
+                    random = self.random
                 )
             )
     
@@ -181,31 +238,59 @@ class Walker:
         turn_angle = self.get_random_small_angle()
         movement_length = self.get_random_small_movement_length()
 
-        # Rotate the direction vector by TURN_ANGLE degrees
-        self.direction = rotate_vector(self.get_direction(), turn_angle)
-
-        final_pos_x = bound(self.grid_size, self.x + self.direction[0] * movement_length)
-        final_pos_y = bound(self.grid_size, self.y + self.direction[1] * movement_length)
-
-        # Move to that position and make all the points along the way 1
-        stride_x = final_pos_x - self.x
-        stride_y = final_pos_y - self.y
-
-        NUM_STEPS = movement_length
-        step_x = stride_x / NUM_STEPS
-        step_y = stride_y / NUM_STEPS
-
-        for _ in range(NUM_STEPS):
-            self.x += step_x
-            self.y += step_y
-            self.paint_perpendicular((self.x, self.y), self.width)
-            self.width_decay()
+        if self.compiled:
+            cos, sin = rotation(turn_angle)
+            direction_x, direction_y = self.get_direction()
+            direction_x, direction_y, centers, widths, self.x, self.y, self.width = straight_move_kernel(
+                float(self.x), float(self.y), float(direction_x), float(direction_y), cos, sin,
+                int(movement_length), float(self.width), float(self.config.walker_path_width_decay), float(self.grid_size)
+            )
+            self.direction = (direction_x, direction_y)
+        else:
+            # Rotate the direction vector by TURN_ANGLE degrees
+            self.direction = rotate_vector(self.get_direction(), turn_angle)
+
+            final_pos_x = bound(self.grid_size, self.x + self.direction[0] * movement_length)
+            final_pos_y = bound(self.grid_size, self.y + self.direction[1] * movement_length)
+
+            # Move to that position and make all the points along the way 1
+            stride_x = final_pos_x - self.x
+            stride_y = final_pos_y - self.y
+
+            NUM_STEPS = movement_length
+            step_x = stride_x / NUM_STEPS
+            step_y = stride_y / NUM_STEPS
+
+            centers = []
+            widths = []
+            for _ in range(NUM_STEPS):
+                self.x += step_x
+                self.y += step_y
+                centers.append((self.x, self.y))
+                widths.append(self.width)
+                self.width_decay()
+        self.canvas.stamp_perpendicular(centers, self.direction, widths)
+        if self.geometry is not None:
+            self.geometry.add_vertices(self.walker_id, centers, self.direction, widths, False)
         
         self.check_bounds_and_die()
 
-    def width_decay(self, decay=WALKER_PATH_WIDTH_DECAY):
+    def width_decay(self, decay=None):
+        if decay is None:
+            decay = self.config.walker_path_width_decay
         self.width *= (1 - decay)
 
+    def width_decay_steps(self, num_steps, decay=None):
+        """
+        Widths of the next num_steps steps, with the width decayed after each of them like width_decay does.
+        The decay is accumulated step by step (not width * (1 - decay) ** k) to get exactly the same widths.
+        """
+        if decay is None:
+            decay = self.config.walker_path_width_decay
+        widths = np.multiply.accumulate(np.concatenate(([self.width], np.full(num_steps, 1 - decay))))
+        self.width = widths[-1]
+        return widths[:-1]
+
     def make_tortuous_move(self):
         turn_angle = self.get_random_small_angle()
         self.direction = rotate_vector(self.get_direction(), turn_angle)
@@ -215,91 +300,40 @@ class Walker:
         return self.make_sine_move(amplitude, wavelength)
         
     def make_sine_move(self, amplitude, wavelength):
-        points = []
+        # The whole segment is a closed form function of the angle, so all the points are computed at once
         initial_x, initial_y = self.x, self.y
         total_angle = 360
         step_length = wavelength / total_angle
         penpendicular_direction = rotate_vector(self.direction, 90)
-        for angle in range(1, total_angle + 1):
-            base_x = initial_x + self.direction[0] * angle * step_length
-            base_y = initial_y + self.direction[1] * angle * step_length
-
-            self.x = base_x + damped_sine(angle, amplitude, t=self.moves) * penpendicular_direction[0]
-            self.y = base_y + damped_sine(angle, amplitude, t=self.moves) * penpendicular_direction[1]
-            
-            self.paint_perpendicular((self.x, self.y), self.width)
-            points.append((self.x, self.y))
-            self.width_decay()
+        angles = np.arange(1, total_angle + 1)
+
+        base_x = initial_x + self.direction[0] * angles * step_length
+        base_y = initial_y + self.direction[1] * angles * step_length
+
+        offsets = damped_sine(angles, amplitude, t=self.moves)
+        xs = base_x + offsets * penpendicular_direction[0]
+        ys = base_y + offsets * penpendicular_direction[1]
+        widths = self.width_decay_steps(total_angle)
+
+        centers = np.stack((xs, ys), axis=-1)
+        self.canvas.stamp_perpendicular(centers, self.direction, widths)
+        if self.geometry is not None:
+            self.geometry.add_vertices(self.walker_id, centers, self.direction, widths, True)
+        self.x, self.y = xs[-1], ys[-1]
         self.check_bounds_and_die()
-        return points
+        return list(zip(xs.tolist(), ys.tolist()))
 
     def get_random_movement_length(self):
-        dist = 0
-        while dist == 0:
-            dist = random.randint(1, math.floor((self.grid_size - 1) * MOVEMENT_LENGTH_LIMITER))
-        return dist
+        return self.random.movement_lengths()
 
     def get_random_small_movement_length(self):
-        dist = 0
-        while dist == 0:
-            dist = math.floor(self.get_random_movement_length() * TORTUOUS_MOVEMENT_LENGTH_LIMITER)
-        return dist
+        return self.random.small_movement_lengths()
     
     def get_random_small_angle(self):
-        return random.randint(-ANGLE_LOWER_BOUND, ANGLE_LOWER_BOUND)
+        return self.random.small_angles()
     
     def get_random_large_angle(self):
-        return np.random.choice(
-            list(range(ANGLE_LOWER_BOUND, ANGLE_UPPER_BOUND)) + 
-            list(range(-ANGLE_UPPER_BOUND, -ANGLE_LOWER_BOUND))
-        )
-    
-    def paint_line(self, start_point, end_point):
-        start_x, start_y = start_point
-        end_x, end_y = end_point
-
-        end_x = bound(self.grid_size, end_x)
-        end_y = bound(self.grid_size, end_y)
-
-        stride_x = end_x - start_x
-        stride_y = end_y - start_y
-
-        NUM_STEPS = math.ceil(np.sqrt(stride_x ** 2 + stride_y ** 2))
-        step_x = stride_x / NUM_STEPS
-        step_y = stride_y / NUM_STEPS
-
-        for _ in range(NUM_STEPS):
-            start_x += step_x
-            start_y += step_y
-            self.paint_point((start_x, start_y))
-
-    def paint_point(self, point):
-        x, y = point
-        x, y = math.floor(x), math.floor(y)
-        if x >= self.grid_size or \
-            y >= self.grid_size or \
-            x < 0 or \
-            y < 0:
-            return
-        self.grid[x][y] = [255, 255, 255]
+        return self.random.large_angles()
     
     def paint_perpendicular(self, point, width):
-        x, y = point
-        pendicular_positive_direction = rotate_vector(self.direction, 90)
-        pendicular_negative_direction = rotate_vector(self.direction, -90)
-
-        self.paint_line(
-            (x, y),
-            (
-                x + pendicular_positive_direction[0] * width,
-                y + pendicular_positive_direction[1] * width
-            )
-        )
-
-        self.paint_line(
-            (x, y),
-            (
-                x + pendicular_negative_direction[0] * width,
-                y + pendicular_negative_direction[1] * width
-            )
-        )
\ No newline at end of file
+        self.canvas.paint_perpendicular(point, self.direction, width)
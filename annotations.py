@@ -0,0 +1,48 @@
+import numpy as np
+
+# "points" is the list of tortuous (x, y) points, the other modes are the compact annotations
+ANNOTATION_MODES = ["points", "mask", "boxes", "mask+boxes"]
+
+def point_set_arrays(tortuous_point_sets):
+    """One (n, 2) float array per tortuous segment, whichever engine produced the segments."""
+    return [np.asarray(list(point_set) if isinstance(point_set, set) else point_set, dtype=np.float64).reshape(-1, 2) for point_set in tortuous_point_sets]
+
+def bounding_boxes(point_sets, grid_size, start_index, end_index):
+    """
+    Bounding box of every tortuous segment, padded by 1% of the grid size, in window coordinates.
+    Rows are inclusive [min_x, min_y, max_x, max_y]. Segments entirely outside the window are dropped.
+    """
+    point_sets = [points for points in point_sets if len(points)]
+    if not point_sets:
+        return np.zeros((0, 4), dtype=np.int64)
+
+    offsets = np.cumsum([0] + [len(points) for points in point_sets[:-1]])
+    points = np.concatenate(point_sets)
+    padding = grid_size * 0.01
+    mins = np.clip(np.floor(np.minimum.reduceat(points, offsets, axis=0) - padding), 0, grid_size - 1)
+    maxs = np.clip(np.floor(np.maximum.reduceat(points, offsets, axis=0) + padding), 0, grid_size - 1)
+
+    in_window = (maxs >= start_index).all(axis=1) & (mins < end_index).all(axis=1)
+    boxes = np.concatenate((mins[in_window], maxs[in_window]), axis=1) - start_index
+    return np.clip(boxes, 0, end_index - start_index - 1).astype(np.int64)
+
+def tortuosity_mask(point_sets, start_index, end_index):
+    """Binary (0/255) mask of the pixels the tortuous segments' centre lines go through, in window coordinates."""
+    size = end_index - start_index
+    mask = np.zeros((size, size), dtype=np.uint8)
+    if not point_sets:
+        return mask
+    points = np.floor(np.concatenate(point_sets)).astype(np.int64) - start_index
+    inside = ((points >= 0) & (points < size)).all(axis=1)
+    mask[points[inside, 0], points[inside, 1]] = 255
+    return mask
+
+def compact_annotation(tortuous_point_sets, mode, grid_size, start_index, end_index):
+    """Annotation dict of a compact mode: the tortuosity "mask" and/or the per-segment "boxes"."""
+    point_sets = point_set_arrays(tortuous_point_sets)
+    annotation = {}
+    if "mask" in mode:
+        annotation["mask"] = tortuosity_mask(point_sets, start_index, end_index)
+    if "boxes" in mode:
+        annotation["boxes"] = bounding_boxes(point_sets, grid_size, start_index, end_index)
+    return annotation
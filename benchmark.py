@@ -0,0 +1,128 @@
+import io
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import itertools
+import subprocess
+import numpy as np
+
+import main
+from stats import ImageStats
+from generator_config import GeneratorConfig
+
+def time_image(tortuous_image, seed, directory, config):
+    """Time the stages of one generate_image call and of encoding and saving its PNG."""
+    stats = ImageStats()
+    start = time.perf_counter()
+    img, _ = main.generate_image(tortuous_image, np.random.default_rng(seed), stats = stats, config = config)
+    total = time.perf_counter() - start
+    painting = stats.phase_times.get("painting", 0.0)
+
+    start = time.perf_counter()
+    img.save(io.BytesIO(), format="PNG")
+    encode = time.perf_counter() - start
+
+    start = time.perf_counter()
+    img.save(os.path.join(directory, "benchmark.png"))
+    save = time.perf_counter() - start
+
+    return {
+        "total": total,
+        "simulation": stats.phase_times["setup"] + stats.phase_times["simulation"],
+        "painting": painting,
+        "conversion": stats.phase_times["rendering"],
+        "annotation": stats.phase_times["annotation"],
+        "encode": encode,
+        "save": save,
+    }
+
+def run_benchmarks(grid_sizes, num_walkers, max_moves, engines, repeats, seed):
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for grid_size, walkers, moves, engine, tortuous_image in itertools.product(grid_sizes, num_walkers, max_moves, engines, [True, False]):
+            config = GeneratorConfig(grid_size = grid_size, num_walkers = walkers, max_moves = moves, simulation_engine = engine)
+            timings = [time_image(tortuous_image, [seed, repeat], directory, config) for repeat in range(repeats)]
+            result = {
+                "grid_size": grid_size,
+                "num_walkers": walkers,
+                "max_moves": moves,
+                "engine": engine,
+                "tortuous": tortuous_image,
+                "repeats": repeats,
+            }
+            for stage in timings[0]:
+                result[f"{stage}_mean"] = float(np.mean([timing[stage] for timing in timings]))
+                result[f"{stage}_min"] = float(np.min([timing[stage] for timing in timings]))
+            results.append(result)
+            print(
+                f"grid={grid_size} walkers={walkers} moves={moves} engine={engine} tortuous={int(tortuous_image)}: "
+                f"total={result['total_mean'] * 1000:.1f}ms "
+                f"simulation={result['simulation_mean'] * 1000:.1f}ms "
+                f"painting={result['painting_mean'] * 1000:.1f}ms "
+                f"conversion={result['conversion_mean'] * 1000:.1f}ms "
+                f"annotation={result['annotation_mean'] * 1000:.1f}ms "
+                f"encode={result['encode_mean'] * 1000:.1f}ms "
+                f"save={result['save_mean'] * 1000:.1f}ms"
+            )
+    return results
+
+def result_key(result):
+    return (result["grid_size"], result["num_walkers"], result["max_moves"], result["engine"], result["tortuous"])
+
+def compare(results, baseline_results, threshold):
+    """Print the slowdowns against a previous run, returns whether any is above threshold."""
+    baseline = {result_key(result): result for result in baseline_results}
+    regressed = False
+    for result in results:
+        key = result_key(result)
+        if key not in baseline:
+            continue
+        # The minimum over the repeats is the least noisy estimate
+        ratio = result["total_min"] / baseline[key]["total_min"]
+        flag = ""
+        if ratio > 1 + threshold:
+            flag = "  <-- REGRESSION"
+            regressed = True
+        print(f"grid={key[0]} walkers={key[1]} moves={key[2]} engine={key[3]} tortuous={int(key[4])}: {ratio:.2f}x{flag}")
+    return regressed
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the image generation hot paths")
+    parser.add_argument("--grid-sizes", type=int, nargs="+", default=[500, 1000, 2000])
+    parser.add_argument("--num-walkers", type=int, nargs="+", default=[6, 20])
+    parser.add_argument("--max-moves", type=int, nargs="+", default=[15, 25])
+    parser.add_argument("--engines", nargs="+", choices=["tree", "population"], default=["tree", "population"])
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="bench_results.json", help="Where to save the results as JSON")
+    parser.add_argument("--compare", default=None, help="Results JSON of a previous run to compare against")
+    parser.add_argument("--threshold", type=float, default=0.1, help="Slowdown (fraction) reported as a regression by --compare")
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.grid_sizes, args.num_walkers, args.max_moves, args.engines, args.repeats, args.seed)
+    with open(args.output, "w") as f:
+        json.dump({
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "machine": platform.machine(),
+            "seed": args.seed,
+            "results": results,
+        }, f, indent=2)
+    print(f"Saved results to {args.output}")
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline_results = json.load(f)["results"]
+        if compare(results, baseline_results, args.threshold):
+            sys.exit(1)
@@ -0,0 +1,295 @@
+import os
+import math
+import time
+import numpy as np
+from PIL import Image
+
+from util import bound, rotate_vector
+from kernels import resolve_backend, stamp_perpendicular_kernel
+from writer import PNG_COMPRESS_LEVEL, write_png
+
+# (cos, sin) of the +90 and -90 degree rotations, as rotate_vector computes them
+PERPENDICULAR_ROTATIONS = np.array([(np.cos(np.radians(angle)), np.sin(np.radians(angle))) for angle in (90, -90)])
+
+class Canvas:
+    """
+    Single channel uint8 grid that the walkers paint into.
+    Indexed as pixels[x][y], the same way the old list-of-lists grid was.
+
+    paint_point / paint_line / paint_perpendicular paint one stroke at a time and are kept as the reference painter.
+    stamp_perpendicular rasterizes a whole batch of perpendicular strokes in one vectorized call and paints exactly the same pixels.
+
+    window = (start, end) only allocates the [start, end) x [start, end) part of the grid that ends up in the image:
+    the strokes keep their full grid geometry but only the pixels inside the window are painted,
+    and pixels[0][0] is the grid point (start, start).
+
+    stats: optional stats.ImageStats, the time spent stamping strokes is added to its "painting" phase.
+    backend: "numpy" or "numba" (see kernels.py), both paint the same pixels.
+    """
+    def __init__(self, grid_size, window = None, stats = None, backend = "numpy"):
+        self.grid_size = grid_size
+        self.stats = stats
+        self.backend = resolve_backend(backend)
+        self.start, self.end = window if window is not None else (0, grid_size)
+        size = self.end - self.start
+        self.pixels = np.zeros((size, size), dtype=np.uint8)
+
+    def image(self, grayscale = False):
+        """The painted window as a PIL image, single channel or 3 channel."""
+        img = Image.fromarray(self.pixels)
+        if not grayscale:
+            img = img.convert("RGB")
+        return img
+
+    def count_painted(self):
+        return int(np.count_nonzero(self.pixels))
+
+    def paint_point(self, point):
+        x, y = point
+        x, y = math.floor(x), math.floor(y)
+        if x >= self.end or \
+            y >= self.end or \
+            x < self.start or \
+            y < self.start:
+            return
+        self.pixels[x - self.start, y - self.start] = 255
+
+    def paint_line(self, start_point, end_point):
+        start_x, start_y = start_point
+        end_x, end_y = end_point
+
+        end_x = bound(self.grid_size, end_x)
+        end_y = bound(self.grid_size, end_y)
+
+        stride_x = end_x - start_x
+        stride_y = end_y - start_y
+
+        NUM_STEPS = math.ceil(np.sqrt(stride_x ** 2 + stride_y ** 2))
+        if NUM_STEPS == 0:
+            return
+        step_x = stride_x / NUM_STEPS
+        step_y = stride_y / NUM_STEPS
+
+        for _ in range(NUM_STEPS):
+            start_x += step_x
+            start_y += step_y
+            self.paint_point((start_x, start_y))
+
+    def paint_perpendicular(self, point, direction, width):
+        x, y = point
+        for angle in (90, -90):
+            perpendicular_direction = rotate_vector(direction, angle)
+            self.paint_line(
+                (x, y),
+                (
+                    x + perpendicular_direction[0] * width,
+                    y + perpendicular_direction[1] * width
+                )
+            )
+
+    def stamp_perpendicular(self, centers, directions, widths):
+        """
+        Paint a batch of perpendicular strokes.
+        centers: (n, 2) stroke centers
+        directions: (n, 2) walker directions, or a single (2,) direction shared by every stroke
+        widths: (n,) half-widths of the strokes
+        """
+        if self.stats is not None:
+            start = time.perf_counter()
+            self._stamp_perpendicular(centers, directions, widths)
+            self.stats.add_time("painting", time.perf_counter() - start)
+        else:
+            self._stamp_perpendicular(centers, directions, widths)
+
+    def _stamp_perpendicular(self, centers, directions, widths):
+        centers = np.asarray(centers, dtype=np.float64).reshape(-1, 2)
+        if len(centers) == 0:
+            return
+        directions = np.broadcast_to(np.asarray(directions, dtype=np.float64), centers.shape)
+        widths = np.broadcast_to(np.asarray(widths, dtype=np.float64), (len(centers),))
+        if self.backend == "numba":
+            stamp_perpendicular_kernel(
+                self.pixels, self.start, self.end, self.grid_size,
+                np.ascontiguousarray(centers), np.ascontiguousarray(directions), np.ascontiguousarray(widths), PERPENDICULAR_ROTATIONS
+            )
+            return
+
+        x, y = centers[:, 0], centers[:, 1]
+        ends = []
+        for cos, sin in PERPENDICULAR_ROTATIONS:
+            # Same arithmetic as rotate_vector so that the strokes match the reference painter bit for bit
+            perpendicular_x = directions[:, 0] * cos - directions[:, 1] * sin
+            perpendicular_y = directions[:, 0] * sin + directions[:, 1] * cos
+            # Bounded like paint_line does, which can stretch a stroke on the edge of the grid far beyond its width
+            ends.append((self._bound(x + perpendicular_x * widths), self._bound(y + perpendicular_y * widths)))
+
+        # Strokes that cannot reach the window are skipped, every painted point lies in the box of the center
+        # and the bounded end points (with a pixel of margin for the rounding of the steps)
+        (first_x, first_y), (second_x, second_y) = ends
+        low_x, high_x = np.minimum(x, np.minimum(first_x, second_x)), np.maximum(x, np.maximum(first_x, second_x))
+        low_y, high_y = np.minimum(y, np.minimum(first_y, second_y)), np.maximum(y, np.maximum(first_y, second_y))
+        near = (low_x < self.end + 1) & (high_x >= self.start - 1) & (low_y < self.end + 1) & (high_y >= self.start - 1)
+        if not near.all():
+            x, y = x[near], y[near]
+            ends = [(end_x[near], end_y[near]) for end_x, end_y in ends]
+
+        for end_x, end_y in ends:
+            self.stamp_lines(x, y, end_x, end_y)
+
+    def stamp_lines(self, start_x, start_y, end_x, end_y):
+        """Vectorized paint_line over arrays of start and end points."""
+        end_x = self._bound(end_x)
+        end_y = self._bound(end_y)
+
+        stride_x = end_x - start_x
+        stride_y = end_y - start_y
+
+        num_steps = np.ceil(np.sqrt(stride_x ** 2 + stride_y ** 2)).astype(np.int64)
+        drawn = num_steps > 0
+        if not drawn.any():
+            return
+        start_x, start_y = start_x[drawn], start_y[drawn]
+        stride_x, stride_y = stride_x[drawn], stride_y[drawn]
+        num_steps = num_steps[drawn]
+
+        max_steps = num_steps.max()
+        # Accumulate the steps one by one (like the reference loop does) instead of start + k * step,
+        # so that the floating point error and hence the painted pixels are identical
+        xs = np.empty((len(num_steps), max_steps + 1))
+        ys = np.empty((len(num_steps), max_steps + 1))
+        xs[:, 0] = start_x
+        ys[:, 0] = start_y
+        xs[:, 1:] = (stride_x / num_steps)[:, None]
+        ys[:, 1:] = (stride_y / num_steps)[:, None]
+        np.add.accumulate(xs, axis=1, out=xs)
+        np.add.accumulate(ys, axis=1, out=ys)
+
+        valid = np.arange(1, max_steps + 1)[None, :] <= num_steps[:, None]
+        self.stamp_points(xs[:, 1:][valid], ys[:, 1:][valid])
+
+    def stamp_points(self, xs, ys):
+        """Vectorized paint_point over arrays of coordinates."""
+        xs = np.floor(xs).astype(np.int64) - self.start
+        ys = np.floor(ys).astype(np.int64) - self.start
+        size = self.end - self.start
+        inside = (xs >= 0) & (xs < size) & (ys >= 0) & (ys < size)
+        self.pixels[xs[inside], ys[inside]] = 255
+
+    def _bound(self, values):
+        return np.where(values < 0, 0, np.where(values >= self.grid_size, self.grid_size - 1, values))
+
+class TiledCanvas(Canvas):
+    """
+    Canvas for very large grids that stores the window as tile_size x tile_size tiles, allocated the first time
+    a stroke paints into them. The vessels are sparse, so most of the tiles of a large image are never allocated.
+    Paints exactly the same pixels as Canvas. The compiled backend paints into a dense array, so it is not used here.
+    """
+    def __init__(self, grid_size, window = None, stats = None, backend = "numpy", tile_size = 256):
+        self.grid_size = grid_size
+        self.stats = stats
+        self.backend = "numpy"
+        self.start, self.end = window if window is not None else (0, grid_size)
+        self.tile_size = tile_size
+        self.num_tiles = math.ceil((self.end - self.start) / tile_size)
+        # (tile row, tile column) -> tile
+        self.tiles = {}
+
+    @property
+    def pixels(self):
+        """The whole window as a dense array, only meant for small grids (see strips())."""
+        return np.concatenate(list(self.strips()))
+
+    def paint_point(self, point):
+        x, y = point
+        self.stamp_points(np.array([x], dtype=np.float64), np.array([y], dtype=np.float64))
+
+    def stamp_points(self, xs, ys):
+        xs = np.floor(xs).astype(np.int64) - self.start
+        ys = np.floor(ys).astype(np.int64) - self.start
+        size = self.end - self.start
+        inside = (xs >= 0) & (xs < size) & (ys >= 0) & (ys < size)
+        xs, ys = xs[inside], ys[inside]
+        if len(xs) == 0:
+            return
+
+        # Group the points by tile and paint each group into its tile
+        keys = (xs // self.tile_size) * self.num_tiles + ys // self.tile_size
+        order = np.argsort(keys, kind="stable")
+        keys, xs, ys = keys[order], xs[order], ys[order]
+        group_starts = np.flatnonzero(np.diff(keys, prepend=-1))
+        for group_start, group_end in zip(group_starts, np.append(group_starts[1:], len(keys))):
+            tile_key = divmod(int(keys[group_start]), self.num_tiles)
+            tile = self.tiles.get(tile_key)
+            if tile is None:
+                tile = self.tiles[tile_key] = np.zeros((self.tile_size, self.tile_size), dtype=np.uint8)
+            tile[xs[group_start:group_end] % self.tile_size, ys[group_start:group_end] % self.tile_size] = 255
+
+    def strips(self):
+        """The window as consecutive strips of tile_size rows (fewer for the last one), assembled one at a time."""
+        size = self.end - self.start
+        for tile_row in range(self.num_tiles):
+            rows = min(self.tile_size, size - tile_row * self.tile_size)
+            strip = np.zeros((rows, self.num_tiles * self.tile_size), dtype=np.uint8)
+            for tile_column in range(self.num_tiles):
+                tile = self.tiles.get((tile_row, tile_column))
+                if tile is not None:
+                    strip[:, tile_column * self.tile_size:(tile_column + 1) * self.tile_size] = tile[:rows]
+            yield strip[:, :size]
+
+    def image(self, grayscale = False):
+        return TiledImage(self, grayscale)
+
+    def count_painted(self):
+        return sum(int(np.count_nonzero(tile)) for tile in self.tiles.values())
+
+class DeferredCanvas:
+    """
+    Stands in for canvas while the walkers move: records their strokes and only paints them on canvas, in the same
+    order, when paint() is called. An attempt rejected before paint() is never painted, at the cost of holding its strokes.
+    """
+    def __init__(self, canvas):
+        self.canvas = canvas
+        self.strokes = []
+
+    def paint_perpendicular(self, point, direction, width):
+        self.strokes.append((self.canvas.paint_perpendicular, (point, direction, width)))
+
+    def stamp_perpendicular(self, centers, directions, widths):
+        self.strokes.append((self.canvas.stamp_perpendicular, (centers, directions, widths)))
+
+    def paint(self):
+        """Paint the recorded strokes and return the canvas."""
+        for paint, stroke in self.strokes:
+            paint(*stroke)
+        self.strokes = []
+        return self.canvas
+
+class TiledImage:
+    """
+    Stand-in for the PIL image of a TiledCanvas: save() streams the PNG strip by strip from the tiles
+    instead of building the whole image, np.asarray() still gives the dense image.
+    """
+    def __init__(self, canvas, grayscale = False):
+        self.canvas = canvas
+        self.grayscale = grayscale
+        size = canvas.end - canvas.start
+        self.size = (size, size)
+        self.mode = "L" if grayscale else "RGB"
+
+    def strips(self):
+        for strip in self.canvas.strips():
+            yield strip if self.grayscale else np.repeat(strip[:, :, None], 3, axis=2)
+
+    def __array__(self, dtype = None, copy = None):
+        pixels = np.concatenate(list(self.strips()))
+        return pixels if dtype is None else pixels.astype(dtype)
+
+    def save(self, fp, format = "PNG", compress_level = PNG_COMPRESS_LEVEL):
+        if format != "PNG":
+            raise ValueError(f"Tiled images can only be saved as PNG, not {format}")
+        if isinstance(fp, (str, bytes, os.PathLike)):
+            with open(fp, "wb") as f:
+                self.save(f, format, compress_level)
+            return
+        width, height = self.size
+        write_png(fp, width, height, 1 if self.grayscale else 3, self.strips(), compress_level)
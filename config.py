@@ -1,5 +1,7 @@
 # Image configuration
 GRID_SIZE = 1000
+# Part of the grid kept in the image, as fractions of GRID_SIZE (the same on both axes)
+CROP_WINDOW = (0.2, 0.8)
 
 # Tortuos Walker configuration
 ANGLE_LOWER_BOUND = 20
@@ -24,4 +26,37 @@ WALKER_CHILD_PATH_WIDTH_MULTIPLIER = 0.5
 # Walker direction configuration
 VECTOR_FIELD_WEIGHT = 0.05
 MIDDLE_LINE_WEIGHT = 0.01
-SINK_STRENGTH = 10
\ No newline at end of file
+SINK_STRENGTH = 10
+
+# Vector field configuration
+# "exact" evaluates the field at every step, "tabulated" interpolates a table built once per image
+VECTOR_FIELD_MODE = "exact"
+VECTOR_FIELD_RESOLUTION = 8
+
+# Simulation engine configuration
+# "tree" moves the recursive Walker objects, "population" advances all the walkers as flat arrays
+SIMULATION_ENGINE = "tree"
+
+# Canvas configuration
+# "dense" paints into one array, "tiled" only allocates the tiles the vessels go through (for very large grids)
+CANVAS_BACKEND = "dense"
+CANVAS_TILE_SIZE = 256
+
+# Compute backend configuration
+# "numpy" is the reference, "numba" runs the stroke painting, the exact walker direction and the straight walker steps as compiled kernels
+COMPUTE_BACKEND = "numpy"
+
+# Random stream configuration
+# "direct" draws the walker decisions one at a time (the reference images), "buffered" draws them in blocks
+RANDOM_STREAM = "direct"
+
+# Acceptance configuration
+# An image that fails a criterion is dropped and simulated again, 0 / None disables the criterion
+# Minimum number of tortuous points inside the crop window of a tortuous image
+MIN_TORTUOUS_POINTS = 0
+# Minimum fraction of the crop window painted
+MIN_COVERAGE = 0.0
+# Maximum number of walkers spawned, checked after every tick of the simulation
+MAX_WALKERS = None
+# Attempts per image before giving up
+MAX_ATTEMPTS = 10
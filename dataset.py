@@ -0,0 +1,100 @@
+import copy
+import threading
+import collections
+import numpy as np
+
+from main import RejectedImageError, generate_image, image_rng
+from generator_config import GeneratorConfig
+
+class TortuosityDataset:
+    """
+    Map-style dataset that generates its samples on demand instead of reading a generated dataset from disk.
+
+    dataset[i] is (image, label, annotation) for the global index i of a run of images_per_class images per class:
+    the same image generate_dataset writes for index i with the same seed and config, tortuous (label 1) for
+    i < images_per_class and non-tortuous (label 0) after. image is a uint8 array, annotation is the list of
+    tortuous points or the annotation dict of the compact annotation modes (see annotations.ANNOTATION_MODES).
+
+    set_epoch(epoch) switches every index to a fresh image (epoch 0 is the generate_dataset image),
+    so a training run can see new samples every epoch.
+
+    The last cache_size samples are kept in an LRU cache and every access returns a copy, so transforming a sample
+    in place does not change the cached one. Every sample only depends on (seed, epoch, index),
+    so the dataset can be copied to any number of data loader workers, each of them keeps its own cache.
+
+    With acceptance criteria in config, an index whose config.max_attempts attempts are all rejected raises
+    main.RejectedImageError (a ValueError): a map-style dataset cannot leave it out like generate_dataset does,
+    so the criteria have to be loose enough for that not to happen, or the data loader has to skip the index.
+    """
+    def __init__(
+            self,
+            images_per_class,
+            config = None,
+            seed = 0,
+            annotation = "points",
+            grayscale = True,
+            cache_size = 128
+        ):
+        self.images_per_class = images_per_class
+        self.config = config if config is not None else GeneratorConfig()
+        self.seed = seed
+        self.annotation = annotation
+        self.grayscale = grayscale
+        self.cache_size = cache_size
+        self.epoch = 0
+        self.cache = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        # The cached samples and the lock are not sent to the workers
+        state = self.__dict__.copy()
+        state["cache"] = collections.OrderedDict()
+        del state["lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return self.images_per_class * 2
+
+    def set_epoch(self, epoch):
+        with self.lock:
+            self.epoch = epoch
+            self.cache.clear()
+
+    def rng(self, index):
+        if self.epoch == 0:
+            return image_rng(self.seed, index)
+        return np.random.default_rng([self.seed, index, self.epoch])
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(f"index {index} out of range for a dataset of {len(self)} images")
+
+        with self.lock:
+            if index in self.cache:
+                self.cache.move_to_end(index)
+                return copy.deepcopy(self.cache[index])
+
+        tortuous_image = index < self.images_per_class
+        try:
+            img, annotation = generate_image(
+                tortuous_image,
+                self.rng(index),
+                self.annotation,
+                grayscale = self.grayscale,
+                config = self.config
+            )
+        except RejectedImageError as error:
+            raise RejectedImageError(f"Image {index} (epoch {self.epoch}): {error}") from error
+        sample = (np.asarray(img), int(tortuous_image), annotation)
+
+        with self.lock:
+            self.cache[index] = sample
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return copy.deepcopy(sample)
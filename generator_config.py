@@ -0,0 +1,96 @@
+import dataclasses
+import numpy as np
+
+import config
+
+@dataclasses.dataclass
+class GeneratorConfig:
+    """
+    All the parameters of the generator in one object, so that several configurations can be used in the same process.
+    The defaults are the values in config.py, the fields are the config.py names in lower case.
+    """
+    # Image configuration
+    grid_size: int = config.GRID_SIZE
+    crop_window: tuple = config.CROP_WINDOW
+
+    # Tortuos Walker configuration
+    angle_lower_bound: int = config.ANGLE_LOWER_BOUND
+    angle_upper_bound: int = config.ANGLE_UPPER_BOUND
+    tortuous_movement_length_limiter: float = config.TORTUOUS_MOVEMENT_LENGTH_LIMITER
+    tortuous_probability: float = config.TORTUOUS_PROBABILITY
+    tortuous_reproduction_probability_multiplier: float = config.TORTUOUS_REPRODUCTION_PROBABILITY_MULTIPLIER
+
+    # General Walker configuration
+    movement_length_limiter: float = config.MOVEMENT_LENGTH_LIMITER
+    num_walkers: int = config.NUM_WALKERS
+    # None is config.NUM_TORTUOUS_WALKERS, scaled to keep the config.py ratio of tortuous walkers for other num_walkers
+    num_tortuous_walkers: int = None
+    max_moves: int = config.MAX_MOVES
+    walker_child_max_moves_multiplier: float = config.WALKER_CHILD_MAX_MOVES_MULTIPLIER
+    walker_maturity_steps: int = config.WALKER_MATURITY_STEPS
+    walker_initial_reproduction_probability: float = config.WALKER_INITIAL_REPRODUCTION_PROBABILITY
+    walker_child_reproduction_probability_multiplier: float = config.WALKER_CHILD_REPRODUCTION_PROBABILITY_MULTIPLIER
+    walker_initial_path_width: float = config.WALKER_INITIAL_PATH_WIDTH
+    walker_path_width_decay: float = config.WALKER_PATH_WIDTH_DECAY
+    walker_child_path_width_multiplier: float = config.WALKER_CHILD_PATH_WIDTH_MULTIPLIER
+
+    # Walker direction configuration
+    vector_field_weight: float = config.VECTOR_FIELD_WEIGHT
+    middle_line_weight: float = config.MIDDLE_LINE_WEIGHT
+    sink_strength: float = config.SINK_STRENGTH
+
+    # Vector field configuration
+    vector_field_mode: str = config.VECTOR_FIELD_MODE
+    vector_field_resolution: int = config.VECTOR_FIELD_RESOLUTION
+
+    # Simulation engine configuration
+    simulation_engine: str = config.SIMULATION_ENGINE
+
+    # Canvas configuration
+    canvas_backend: str = config.CANVAS_BACKEND
+    canvas_tile_size: int = config.CANVAS_TILE_SIZE
+
+    # Compute backend configuration
+    compute_backend: str = config.COMPUTE_BACKEND
+
+    # Random stream configuration
+    random_stream: str = config.RANDOM_STREAM
+
+    # Acceptance configuration
+    min_tortuous_points: int = config.MIN_TORTUOUS_POINTS
+    min_coverage: float = config.MIN_COVERAGE
+    max_walkers: int = config.MAX_WALKERS
+    max_attempts: int = config.MAX_ATTEMPTS
+
+    def __post_init__(self):
+        if self.num_tortuous_walkers is None:
+            if self.num_walkers == config.NUM_WALKERS:
+                self.num_tortuous_walkers = config.NUM_TORTUOUS_WALKERS
+            else:
+                self.num_tortuous_walkers = int(self.num_walkers * (config.NUM_TORTUOUS_WALKERS / config.NUM_WALKERS))
+        self.crop_window = tuple(self.crop_window)
+
+    @classmethod
+    def from_dict(cls, values, strict = False):
+        """
+        Build a config from a dict of parameters, named either like the fields or like config.py (upper case).
+        Names that are not parameters of the generator are ignored,
+        so the genetic search individuals can be passed as they are.
+        strict raises ValueError on them instead, to catch misspelled parameters in a config file.
+        """
+        fields = {field.name for field in dataclasses.fields(cls)}
+        unknown = [name for name in values if name.lower() not in fields]
+        if strict and unknown:
+            raise ValueError(f"Unknown generator parameters {unknown}, expected config.py or GeneratorConfig names")
+        return cls(**{
+            # NumPy scalars (np.random.choice picks) become plain Python values so the config can be saved as JSON
+            name.lower(): value.item() if isinstance(value, np.generic) else value
+            for name, value in values.items()
+            if name.lower() in fields
+        })
+
+    def has_acceptance_criteria(self):
+        return self.min_tortuous_points > 0 or self.min_coverage > 0 or self.max_walkers is not None
+
+    def to_dict(self):
+        return dataclasses.asdict(self)
@@ -0,0 +1,168 @@
+import math
+import numpy as np
+
+from canvas import Canvas
+from util import crop_window
+
+class GeometryRecorder:
+    """
+    Records the vessel network of one image while it is simulated.
+    Pass one to generate_image, which hands it to the walkers: every stroke they paint is recorded as a vertex
+    (centre point, walker direction, half-width, tortuous flag) of the polyline of its walker.
+    geometry() then returns the compact VesselGeometry.
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """Forget everything recorded, for a new attempt at the image."""
+        self.grid_size = None
+        self.window = None
+        self.source_point = None
+        self.parent_ids = []
+        self.spawn_vertices = []
+        self.vertex_counts = []
+        self.chunks = []
+
+    def add_walker(self, parent_id = -1):
+        """Register a new walker, returns its id. A child starts where its parent's last vertex is."""
+        walker_id = len(self.parent_ids)
+        self.parent_ids.append(parent_id)
+        self.spawn_vertices.append(self.vertex_counts[parent_id] - 1 if parent_id >= 0 else -1)
+        self.vertex_counts.append(0)
+        return walker_id
+
+    def add_vertices(self, walker_ids, centers, directions, widths, tortuous):
+        """
+        Record a batch of strokes in painting order.
+        walker_ids, directions, widths and tortuous are per stroke or shared by the whole batch.
+        """
+        centers = np.asarray(centers, dtype=np.float64).reshape(-1, 2)
+        count = len(centers)
+        if count == 0:
+            return
+        walker_ids = np.broadcast_to(np.asarray(walker_ids, dtype=np.int64), (count,))
+        self.chunks.append((
+            walker_ids,
+            centers,
+            np.broadcast_to(np.asarray(directions, dtype=np.float64), (count, 2)),
+            np.broadcast_to(np.asarray(widths, dtype=np.float64), (count,)),
+            np.broadcast_to(np.asarray(tortuous, dtype=bool), (count,)),
+        ))
+        for walker_id, walker_count in zip(*np.unique(walker_ids, return_counts=True)):
+            self.vertex_counts[walker_id] += int(walker_count)
+
+    def geometry(self):
+        if self.chunks:
+            walker_ids, centers, directions, widths, tortuous = (np.concatenate(arrays) for arrays in zip(*self.chunks))
+        else:
+            walker_ids = np.empty(0, dtype=np.int64)
+            centers, directions = np.empty((0, 2)), np.empty((0, 2))
+            widths, tortuous = np.empty(0), np.empty(0, dtype=bool)
+        # Group the vertices by walker, the stable sort keeps each walker's vertices in painting order
+        order = np.argsort(walker_ids, kind="stable")
+        return VesselGeometry(
+            grid_size = self.grid_size,
+            window = self.window,
+            source_point = self.source_point,
+            vertices = centers[order],
+            directions = directions[order],
+            widths = widths[order],
+            tortuous = tortuous[order],
+            offsets = np.concatenate(([0], np.cumsum(self.vertex_counts))).astype(np.int64),
+            parent_ids = np.array(self.parent_ids, dtype=np.int64),
+            spawn_vertices = np.array(self.spawn_vertices, dtype=np.int64),
+        )
+
+class VesselGeometry:
+    """
+    Vessel network of one image as polylines, one per walker.
+
+    The vertices of walker i are vertices[offsets[i]:offsets[i + 1]] (in grid coordinates), with the walker direction,
+    half-width and tortuous flag of each of them. parent_ids[i] is the walker it branched from (-1 for the initial walkers)
+    and spawn_vertices[i] the index, in the parent's polyline, of the vertex it branched at.
+    window is the (start, end) pixel range of the grid that was kept in the image.
+    """
+    ARRAYS = ["vertices", "directions", "widths", "tortuous", "offsets", "parent_ids", "spawn_vertices"]
+
+    def __init__(self, grid_size, window, source_point, vertices, directions, widths, tortuous, offsets, parent_ids, spawn_vertices):
+        self.grid_size = grid_size
+        self.window = window
+        self.source_point = source_point
+        self.vertices = vertices
+        self.directions = directions
+        self.widths = widths
+        self.tortuous = tortuous
+        self.offsets = offsets
+        self.parent_ids = parent_ids
+        self.spawn_vertices = spawn_vertices
+
+    def __len__(self):
+        return len(self.parent_ids)
+
+    def polyline(self, walker_id):
+        return self.vertices[self.offsets[walker_id]:self.offsets[walker_id + 1]]
+
+    def save(self, filename):
+        np.savez_compressed(
+            filename,
+            grid_size = self.grid_size,
+            window = self.window,
+            source_point = self.source_point,
+            **{name: getattr(self, name) for name in self.ARRAYS}
+        )
+
+    @classmethod
+    def load(cls, filename):
+        with np.load(filename) as data:
+            return cls(
+                grid_size = int(data["grid_size"]),
+                window = tuple(data["window"].tolist()),
+                source_point = tuple(data["source_point"].tolist()),
+                **{name: data[name] for name in cls.ARRAYS}
+            )
+
+    def densified(self, steps):
+        """
+        Centers, directions and widths with steps - 1 linearly interpolated strokes between the consecutive vertices
+        of every polyline, to keep the strokes about a pixel apart when the geometry is scaled up.
+        """
+        if steps <= 1 or len(self.vertices) < 2:
+            return self.vertices, self.directions, self.widths
+        # Vertex k is followed by vertex k + 1 unless it is the last vertex of its polyline
+        last = np.zeros(len(self.vertices), dtype=bool)
+        last[self.offsets[1:][self.offsets[1:] > 0] - 1] = True
+        inner = np.flatnonzero(~last[:-1])
+
+        fractions = np.arange(1, steps) / steps
+        starts, ends = self.vertices[inner], self.vertices[inner + 1]
+        centers = starts[:, None, :] + (ends - starts)[:, None, :] * fractions[None, :, None]
+        widths = self.widths[inner][:, None] + (self.widths[inner + 1] - self.widths[inner])[:, None] * fractions[None, :]
+        directions = np.repeat(self.directions[inner], steps - 1, axis=0)
+        return (
+            np.concatenate((self.vertices, centers.reshape(-1, 2))),
+            np.concatenate((self.directions, directions)),
+            np.concatenate((self.widths, widths.ravel()))
+        )
+
+def render_geometry(geometry, scale = 1, window = None):
+    """
+    Rasterize a recorded geometry, scaled by scale, into a single channel uint8 array (indexed like Canvas.pixels).
+    window = (start, end) fractions of the grid to keep, the recorded image's window if not given.
+    At scale 1 with the recorded window the pixels are exactly the ones generate_image painted.
+    """
+    grid_size = round(geometry.grid_size * scale)
+    if window is None:
+        start_index, end_index = (round(index * scale) for index in geometry.window)
+    else:
+        start_index, end_index = crop_window(grid_size, window)
+    canvas = Canvas(grid_size, (start_index, end_index))
+
+    if scale == 1:
+        centers, directions, widths = geometry.vertices, geometry.directions, geometry.widths
+    else:
+        centers, directions, widths = geometry.densified(math.ceil(scale))
+        centers = centers * scale
+        widths = widths * scale
+    canvas.stamp_perpendicular(centers, directions, widths)
+    return canvas.pixels
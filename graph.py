@@ -0,0 +1,146 @@
+import collections
+import numpy as np
+
+class VesselGraph:
+    """
+    Vessel network of one image as a graph: nodes at the start of the initial walkers, at the points where walkers branch
+    and at the end of every walker, edges along the walker paths between them.
+
+    edge_lengths are the path lengths of the edges in pixels, edge_window_lengths the part of them inside the crop window.
+    edge_tortuous is the fraction of the edge drawn by tortuous moves, edge_widths its mean half-width.
+    edge_walkers is the walker (index in the geometry) that drew the edge.
+    """
+    def __init__(self, node_positions, edge_nodes, edge_lengths, edge_window_lengths, edge_tortuous, edge_widths, edge_walkers):
+        self.node_positions = node_positions
+        self.edge_nodes = edge_nodes
+        self.edge_lengths = edge_lengths
+        self.edge_window_lengths = edge_window_lengths
+        self.edge_tortuous = edge_tortuous
+        self.edge_widths = edge_widths
+        self.edge_walkers = edge_walkers
+
+    def node_degrees(self):
+        return np.bincount(self.edge_nodes.ravel(), minlength=len(self.node_positions))
+
+    def branches(self, in_window = True):
+        """
+        The branches a skeleton of the image would have: the edges, with the chains of edges through nodes
+        of degree 2 (a walker branching at its very last vertex) merged into one.
+        Returns the (n, 2) end nodes and the lengths of the branches.
+        in_window only keeps the branches, and the part of them, inside the crop window.
+        """
+        lengths = self.edge_window_lengths if in_window else self.edge_lengths
+        ends = [list(edge) for edge in self.edge_nodes.tolist()]
+        lengths = lengths.tolist()
+        alive = [True] * len(ends)
+        incident = collections.defaultdict(list)
+        for edge, (a, b) in enumerate(ends):
+            incident[a].append(edge)
+            incident[b].append(edge)
+
+        for node in np.flatnonzero(self.node_degrees() == 2).tolist():
+            first, second = incident[node]
+            if first == second:
+                continue
+            # Replace the two edges by one between their other ends
+            other_first = ends[first][0] if ends[first][1] == node else ends[first][1]
+            other_second = ends[second][0] if ends[second][1] == node else ends[second][1]
+            merged = len(ends)
+            ends.append([other_first, other_second])
+            lengths.append(lengths[first] + lengths[second])
+            alive[first] = alive[second] = False
+            alive.append(True)
+            for other, edge in ((other_first, first), (other_second, second)):
+                incident[other] = [merged if incident_edge == edge else incident_edge for incident_edge in incident[other]]
+
+        ends, lengths, alive = np.array(ends, dtype=np.int64).reshape(-1, 2), np.array(lengths), np.array(alive, dtype=bool)
+        kept = alive & (lengths > 0)
+        return ends[kept], lengths[kept]
+
+    def summary(self, in_window = True):
+        """
+        Branch metrics in the format of the skeleton analysis of the genetic search (search.image_metrics):
+        mean branch length, number of branches and the number of branches of each type
+        (0: endpoint to endpoint, 1: junction to endpoint, 2: junction to junction), computed from branches().
+        """
+        ends, lengths = self.branches(in_window)
+        junctions = self.node_degrees() >= 3
+        branch_types = junctions[ends].sum(axis=1)
+        return {
+            "mean_branch_length": float(lengths.mean()) if len(lengths) else float("nan"),
+            "num_branches": len(lengths),
+            **{f"branch_types_{type}": int(count) for type, count in zip(*np.unique(branch_types, return_counts=True))},
+        }
+
+def vessel_graph(geometry):
+    """Build the VesselGraph of a recorded geometry.VesselGeometry."""
+    start_index, end_index = geometry.window
+    spawns = collections.defaultdict(list)
+    for child, parent in enumerate(geometry.parent_ids):
+        if parent >= 0:
+            spawns[parent].append(max(int(geometry.spawn_vertices[child]), 0))
+
+    nodes = {}
+    node_positions = []
+    def node(walker, vertex):
+        key = (walker, vertex)
+        if key not in nodes:
+            nodes[key] = len(node_positions)
+            node_positions.append(geometry.vertices[geometry.offsets[walker] + vertex])
+        return nodes[key]
+
+    edges = []
+    for walker in range(len(geometry)):
+        first, last = geometry.offsets[walker], geometry.offsets[walker + 1]
+        if first == last:
+            continue
+        parent = geometry.parent_ids[walker]
+        # A child's path starts at the vertex of its parent it branched at
+        if parent >= 0 and geometry.offsets[parent] < geometry.offsets[parent + 1]:
+            spawn = max(int(geometry.spawn_vertices[walker]), 0)
+            start_node = node(parent, spawn)
+            points = np.concatenate(([geometry.vertices[geometry.offsets[parent] + spawn]], geometry.vertices[first:last]))
+            path_offset = 1
+        else:
+            start_node = node(walker, 0)
+            points = geometry.vertices[first:last]
+            path_offset = 0
+
+        segment_lengths = np.hypot(*np.diff(points, axis=0).T)
+        inside = ((points >= start_index) & (points < end_index)).all(axis=1)
+        segment_window_lengths = np.where(inside[:-1] & inside[1:], segment_lengths, 0)
+
+        # The path is split at every vertex a child branches at, and ends at its last vertex
+        splits = sorted({vertex + path_offset for vertex in spawns[walker]} | {len(points) - 1})
+        previous, previous_node = 0, start_node
+        for split in splits:
+            if split == previous:
+                continue
+            # Vertices (previous, split] of the path are the walker's vertices drawn along the edge
+            vertices = slice(first + previous + 1 - path_offset, first + split + 1 - path_offset)
+            split_node = node(walker, split - path_offset)
+            edges.append((
+                previous_node,
+                split_node,
+                segment_lengths[previous:split].sum(),
+                segment_window_lengths[previous:split].sum(),
+                geometry.tortuous[vertices].mean(),
+                geometry.widths[vertices].mean(),
+                walker
+            ))
+            previous, previous_node = split, split_node
+
+    if edges:
+        edge_from, edge_to, lengths, window_lengths, tortuous, widths, walkers = (np.array(values) for values in zip(*edges))
+    else:
+        edge_from = edge_to = walkers = np.empty(0, dtype=np.int64)
+        lengths = window_lengths = tortuous = widths = np.empty(0)
+    return VesselGraph(
+        node_positions = np.array(node_positions, dtype=np.float64).reshape(-1, 2),
+        edge_nodes = np.stack((edge_from, edge_to), axis=-1).astype(np.int64),
+        edge_lengths = lengths.astype(np.float64),
+        edge_window_lengths = window_lengths.astype(np.float64),
+        edge_tortuous = tortuous.astype(np.float64),
+        edge_widths = widths.astype(np.float64),
+        edge_walkers = walkers.astype(np.int64)
+    )
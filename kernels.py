@@ -0,0 +1,188 @@
+import math
+import warnings
+import argparse
+import functools
+import numpy as np
+
+# Numba is optional, the "numba" compute backend falls back to the NumPy one when it is not installed
+try:
+    import numba
+except ImportError:
+    numba = None
+
+BACKENDS = ["numpy", "numba"]
+
+def jit(function):
+    if numba is None:
+        return function
+    return numba.njit(cache=True)(function)
+
+def resolve_backend(backend):
+    """The backend that will actually run: "numba" falls back to "numpy" (with a warning) when Numba is missing."""
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown compute backend {backend!r}, expected one of {BACKENDS}")
+    if backend == "numba" and numba is None:
+        warnings.warn("Numba is not installed, using the numpy compute backend")
+        return "numpy"
+    return backend
+
+@jit
+def stamp_perpendicular_kernel(pixels, start, end, grid_size, centers, directions, widths, rotations):
+    """
+    Compiled Canvas.stamp_perpendicular: paints the strokes one by one with the same arithmetic as
+    paint_perpendicular / paint_line, so the painted pixels are the same as the NumPy backend's.
+    rotations holds the (cos, sin) of the +90 and -90 degree rotations, computed by NumPy like rotate_vector does.
+    """
+    size = end - start
+    ends = np.empty((rotations.shape[0], 2))
+    for i in range(centers.shape[0]):
+        x = centers[i, 0]
+        y = centers[i, 1]
+        width = widths[i]
+        low_x = high_x = x
+        low_y = high_y = y
+        for r in range(rotations.shape[0]):
+            cos = rotations[r, 0]
+            sin = rotations[r, 1]
+            end_x = x + (directions[i, 0] * cos - directions[i, 1] * sin) * width
+            end_y = y + (directions[i, 0] * sin + directions[i, 1] * cos) * width
+            if end_x < 0:
+                end_x = 0.0
+            elif end_x >= grid_size:
+                end_x = grid_size - 1.0
+            if end_y < 0:
+                end_y = 0.0
+            elif end_y >= grid_size:
+                end_y = grid_size - 1.0
+            ends[r, 0] = end_x
+            ends[r, 1] = end_y
+            low_x, high_x = min(low_x, end_x), max(high_x, end_x)
+            low_y, high_y = min(low_y, end_y), max(high_y, end_y)
+        # Strokes that cannot reach the window are skipped, every painted point lies in the box of the center
+        # and the bounded end points (with a pixel of margin for the rounding of the steps)
+        if low_x >= end + 1 or high_x < start - 1 or low_y >= end + 1 or high_y < start - 1:
+            continue
+
+        for r in range(rotations.shape[0]):
+            stride_x = ends[r, 0] - x
+            stride_y = ends[r, 1] - y
+            num_steps = math.ceil(math.sqrt(stride_x * stride_x + stride_y * stride_y))
+            if num_steps == 0:
+                continue
+            step_x = stride_x / num_steps
+            step_y = stride_y / num_steps
+            point_x = x
+            point_y = y
+            for _ in range(num_steps):
+                point_x += step_x
+                point_y += step_y
+                pixel_x = math.floor(point_x) - start
+                pixel_y = math.floor(point_y) - start
+                if 0 <= pixel_x < size and 0 <= pixel_y < size:
+                    pixels[pixel_x, pixel_y] = 255
+
+@jit
+def direction_kernel(x, y, direction_x, direction_y, source_x, source_y, grid_size, sink_strength, vector_field_weight, middle_line_weight):
+    """
+    Compiled exact Walker.get_direction (same operations in the same order).
+    The caller handles the walker standing exactly on the source or the sink, where the field is undefined.
+    """
+    sink_x = grid_size - source_x
+    sink_y = grid_size - source_y
+
+    den = math.pow(math.hypot(x - source_x, y - source_y), 3.0)
+    ex = (x - source_x) / den
+    ey = (y - source_y) / den
+    q = -1 * sink_strength
+    den = math.pow(math.hypot(x - sink_x, y - sink_y), 3.0)
+    ex_ = q * (x - sink_x) / den
+    ey_ = q * (y - sink_y) / den
+
+    field_x = ex + ex_
+    field_y = ey + ey_
+    norm = math.sqrt(field_x * field_x + field_y * field_y)
+    field_x, field_y = field_x / norm, field_y / norm
+
+    line_x = (source_x + sink_x) / 2 - x
+    line_y = (source_y + sink_y) / 2 - y
+    norm = math.sqrt(line_x * line_x + line_y * line_y)
+    line_x, line_y = line_x / norm, line_y / norm
+
+    momentum_weight = 1 - vector_field_weight - middle_line_weight
+    total_x = field_x * vector_field_weight + line_x * middle_line_weight + direction_x * momentum_weight
+    total_y = field_y * vector_field_weight + line_y * middle_line_weight + direction_y * momentum_weight
+    norm = math.sqrt(total_x * total_x + total_y * total_y)
+    return total_x / norm, total_y / norm
+
+@functools.lru_cache(maxsize=None)
+def rotation(angle):
+    """(cos, sin) of a rotation by angle degrees, computed by NumPy exactly like util.rotate_vector."""
+    angle_rads = np.radians(angle)
+    return float(np.cos(angle_rads)), float(np.sin(angle_rads))
+
+@jit
+def straight_move_kernel(x, y, direction_x, direction_y, cos, sin, movement_length, width, decay, grid_size):
+    """
+    Compiled Walker.make_small_move_straight once the turn angle and the movement length are drawn:
+    rotates the direction by (cos, sin) like rotate_vector, then takes movement_length steps towards the bounded
+    end point, decaying the width after every step like width_decay.
+    Returns the new direction, the stroke centers and widths, and the position and width after the move.
+    """
+    direction_x, direction_y = direction_x * cos - direction_y * sin, direction_x * sin + direction_y * cos
+
+    final_x = x + direction_x * movement_length
+    if final_x < 0:
+        final_x = 0.0
+    elif final_x >= grid_size:
+        final_x = grid_size - 1.0
+    final_y = y + direction_y * movement_length
+    if final_y < 0:
+        final_y = 0.0
+    elif final_y >= grid_size:
+        final_y = grid_size - 1.0
+    step_x = (final_x - x) / movement_length
+    step_y = (final_y - y) / movement_length
+
+    centers = np.empty((movement_length, 2))
+    widths = np.empty(movement_length)
+    for i in range(movement_length):
+        x += step_x
+        y += step_y
+        centers[i, 0] = x
+        centers[i, 1] = y
+        widths[i] = width
+        width *= (1 - decay)
+    return direction_x, direction_y, centers, widths, x, y, width
+
+def check_backends(seeds, config):
+    """Generate every seed with both backends, returns the seeds whose images or annotations differ."""
+    # Imported here, main imports the canvas which imports this module
+    import dataclasses
+    from main import generate_image
+
+    mismatches = []
+    for seed in seeds:
+        images = []
+        for backend in BACKENDS:
+            backend_config = dataclasses.replace(config, compute_backend = backend)
+            img, tortuous_points = generate_image(seed % 2 == 0, np.random.default_rng(seed), config = backend_config)
+            images.append((np.asarray(img), sorted(tortuous_points)))
+        (numpy_pixels, numpy_points), (numba_pixels, numba_points) = images
+        if not np.array_equal(numpy_pixels, numba_pixels) or numpy_points != numba_points:
+            mismatches.append(seed)
+    return mismatches
+
+if __name__ == "__main__":
+    from generator_config import GeneratorConfig
+
+    parser = argparse.ArgumentParser(description="Check that the numba compute backend generates the same images as the numpy one")
+    parser.add_argument("--seeds", type=int, default=10, help="Number of seeds to compare")
+    parser.add_argument("--engine", choices=["tree", "population"], default="tree")
+    args = parser.parse_args()
+
+    if numba is None:
+        raise SystemExit("Numba is not installed, nothing to compare")
+    mismatches = check_backends(range(args.seeds), GeneratorConfig(simulation_engine = args.engine))
+    if mismatches:
+        raise SystemExit(f"The backends differ for seeds {mismatches}")
+    print(f"The numpy and numba backends generate the same {args.seeds} images")
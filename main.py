@@ -1,28 +1,77 @@
 from PIL import Image
 import numpy as np
-import pandas as pd
+import argparse
+import multiprocessing
 import os
 import datetime
 import tqdm
 import shutil
 import math 
+import itertools
+import functools
+import json
+import glob
+import queue
+import pandas as pd
 from Walker import Walker
-from util import bound, generate_centered_point, rotate_vector
-from config import GRID_SIZE, NUM_TORTUOUS_WALKERS, NUM_WALKERS, WALKER_INITIAL_REPRODUCTION_PROBABILITY
+from population import WalkerPopulation
+from random_stream import random_stream
+from writer import PNG_COMPRESS_LEVEL, BackgroundWriter, ManifestWriter, ShardWriter, atomic_write, run_finished, save_image, write_run_info
+from canvas import Canvas, DeferredCanvas, TiledCanvas
+from stats import REJECTION_REASONS, ImageStats, PhaseClock
+from annotations import ANNOTATION_MODES, compact_annotation
+from vector_field import VectorField
+from util import bound, crop_window, generate_centered_point, rotate_vector
+from generator_config import GeneratorConfig
 
-def generate_image(tortuous_image):
-    img = [[[0, 0, 0] for _ in range(GRID_SIZE)] for _ in range(GRID_SIZE)]
+class RejectedImageError(ValueError):
+    """No attempt at an image met the acceptance criteria of its config."""
+
+def simulate_image(tortuous_image, rng, config, start_index, end_index, clock, stats = None, counters = None, geometry = None, abort = None, defer_painting = False):
+    """
+    One attempt at the image of generate_image: paints the walkers on a new canvas of the window [start_index, end_index).
+    counters: the stats.ImageStats the walkers count themselves in (stats, or a private one for the acceptance criteria).
+    abort is called after every tick and abandons the simulation when it returns True.
+    defer_painting returns a canvas.DeferredCanvas holding the strokes, painted by its paint() once the attempt is kept.
+    Returns the canvas, the tortuous point sets and whether the simulation ran to the end.
+    """
+    GRID_SIZE = config.grid_size
+    NUM_WALKERS = config.num_walkers
+    NUM_TORTUOUS_WALKERS = config.num_tortuous_walkers
+    if config.canvas_backend == "tiled":
+        canvas = TiledCanvas(GRID_SIZE, (start_index, end_index), stats = stats, tile_size = config.canvas_tile_size)
+    else:
+        canvas = Canvas(GRID_SIZE, (start_index, end_index), stats = stats, backend = config.compute_backend)
+    if defer_painting:
+        canvas = DeferredCanvas(canvas)
 
     # Spawn walkers somewhere in the middle of the image
-    SOURCE_POINT = generate_centered_point(GRID_SIZE)
+    SOURCE_POINT = generate_centered_point(GRID_SIZE, rng)
+    if geometry is not None:
+        geometry.grid_size = GRID_SIZE
+        geometry.window = (start_index, end_index)
+        geometry.source_point = SOURCE_POINT
+
+    # The vector field only depends on the source point, so tabulate it once for the whole image
+    vector_field = None
+    if config.vector_field_mode == "tabulated":
+        vector_field = VectorField(
+            SOURCE_POINT,
+            GRID_SIZE,
+            resolution = config.vector_field_resolution,
+            sink_strength = config.sink_strength,
+            vector_field_weight = config.vector_field_weight,
+            middle_line_weight = config.middle_line_weight
+        )
     
     # Initialize walkers
-    walkers = []
     if tortuous_image:
         walker_is_tortuous = [False] * (NUM_WALKERS - NUM_TORTUOUS_WALKERS) + [True] * NUM_TORTUOUS_WALKERS
-        np.random.shuffle(walker_is_tortuous)
+        rng.shuffle(walker_is_tortuous)
     else:
         walker_is_tortuous = [False] * NUM_WALKERS
+    start_points = []
+    initial_directions = []
     for i in range(NUM_WALKERS):
         # Slightly move the walker away from the initial point in all directions uniformly
         # This is because, the vector field force direction is undefined at the source
@@ -36,122 +85,642 @@ def generate_image(tortuous_image):
             GRID_SIZE,
             initial_y + np.sin(angle) * GRID_SIZE * 0.01
         )
-        start_point = (start_x, start_y)
-
-        walker = Walker(
-                grid = img, 
-                grid_size = GRID_SIZE,
-                tortuous = walker_is_tortuous[i],
-                reproduction_probability = WALKER_INITIAL_REPRODUCTION_PROBABILITY,
-                initial_point = start_point,
-                source_point = SOURCE_POINT,
-                initial_direction = rotate_vector((1, 0), (i * 360) / NUM_WALKERS) # Spread the walkers out evenly
-            )
-        walkers.append(walker)
+        start_points.append((start_x, start_y))
+        initial_directions.append(rotate_vector((1, 0), (i * 360) / NUM_WALKERS)) # Spread the walkers out evenly
+
+    clock.lap("setup")
+    if config.simulation_engine == "population":
+        population = WalkerPopulation(canvas, GRID_SIZE, SOURCE_POINT, rng, vector_field, stats = counters, config = config, geometry = geometry)
+        population.add_walkers(
+            x = [x for x, _ in start_points],
+            y = [y for _, y in start_points],
+            direction_x = [x for x, _ in initial_directions],
+            direction_y = [y for _, y in initial_directions],
+            tortuous = walker_is_tortuous,
+            reproduction_probability = config.walker_initial_reproduction_probability,
+            max_moves = config.max_moves
+        )
+        if not population.run(abort):
+            return canvas, None, False
+        tortuous_point_sets = population.tortuous_point_sets
+    else:
+        # One random stream for all the walkers of the image
+        random = random_stream(rng, GRID_SIZE, config)
+        walkers = []
+        for i in range(NUM_WALKERS):
+            walker = Walker(
+                    canvas = canvas, 
+                    grid_size = GRID_SIZE,
+                    tortuous = walker_is_tortuous[i],
+                    reproduction_probability = config.walker_initial_reproduction_probability,
+                    max_moves = config.max_moves,
+                    initial_point = start_points[i],
+                    source_point = SOURCE_POINT,
+                    initial_direction = initial_directions[i],
+                    vector_field = vector_field,
+                    rng = rng,
+                    stats = counters,
+                    config = config,
+                    geometry = geometry,
+                    random = random
+                )
+            walkers.append(walker)
+
+        # Let the walkers move until they all die
+        while True:
+            alive = False
+            for walker in walkers:
+                alive |= walker.move()
+
+            if abort is not None and abort():
+                return canvas, None, False
+            if not alive:
+                break
+
+        # Get the tortuous points
+        tortuous_point_sets = []
+        for w in walkers:
+            if w.tortuous:
+                tortuous_point_sets += w.get_tortuous_points()
+
+    return canvas, tortuous_point_sets, True
 
-    # Let the walkers move until they all die
-    while True:
-        alive = False
-        for walker in walkers:
-            alive |= walker.move()
+def generate_image(tortuous_image, rng = None, annotation = "points", grayscale = False, window = None, stats = None, config = None, geometry = None):
+    """
+    Generate one image. Every random draw goes through `rng` (a numpy.random.Generator),
+    so the image is fully determined by the generator's seed.
 
-        if not alive:
+    annotation selects what is returned along with the image (see annotations.ANNOTATION_MODES):
+    "points" returns the list of tortuous (x, y) points in the image,
+    the other modes return a dict with the binary tortuosity "mask" and/or the per-segment bounding "boxes".
+    grayscale returns a single channel image instead of the 3 channel one.
+    With config.canvas_backend "tiled" the image is a canvas.TiledImage, which is saved as a PNG strip by strip.
+    config: generator_config.GeneratorConfig with the generator parameters, the config.py values if not given.
+    window = (start, end) is the part of the grid kept in the image, as fractions of the grid size (config.crop_window by default).
+    Only the window is allocated and painted and the annotations are in window coordinates,
+    the walkers still move on the whole grid.
+    stats: optional stats.ImageStats filled in with the walker counters and the time spent in each phase.
+    geometry: optional geometry.GeometryRecorder filled in with the vessel network, to render it again at other resolutions.
+    With acceptance criteria in config (min_tortuous_points, min_coverage, max_walkers) an image that fails them is
+    simulated again, before it is rendered; RejectedImageError is raised after config.max_attempts failed attempts.
+    stats.rejections counts the rejected attempts.
+    """
+    clock = PhaseClock(stats)
+    if rng is None:
+        rng = np.random.default_rng()
+    if config is None:
+        config = GeneratorConfig()
+    if window is None:
+        window = config.crop_window
+    start_index, end_index = crop_window(config.grid_size, window)
+
+    # With acceptance criteria the walkers and the rejected attempts are always counted
+    counters = stats if stats is not None or not config.has_acceptance_criteria() else ImageStats()
+    abort = None
+    if config.max_walkers is not None:
+        abort = lambda: counters.walkers_spawned > config.max_walkers
+    # Only min_coverage needs the painted canvas, the other criteria are checked before the strokes are painted
+    check_tortuous_points = tortuous_image and config.min_tortuous_points > 0
+    defer_painting = abort is not None or check_tortuous_points
+
+    # Attempts that fail the acceptance criteria are dropped, the next one goes on with the same random generator
+    for attempt in range(config.max_attempts):
+        canvas, tortuous_point_sets, completed = simulate_image(
+            tortuous_image, rng, config, start_index, end_index, clock, stats, counters, geometry, abort, defer_painting
+        )
+        clock.lap("simulation")
+        rejection, tortuous_points, pixels_painted = None, None, None
+        if not completed:
+            rejection = "max_walkers"
+        elif check_tortuous_points:
+            tortuous_points = window_tortuous_points(tortuous_point_sets, start_index, end_index)
+            if len(tortuous_points) < config.min_tortuous_points:
+                rejection = "min_tortuous_points"
+        if rejection is None and defer_painting:
+            canvas = canvas.paint()
+            clock.lap("simulation")
+        if rejection is None and config.min_coverage > 0:
+            pixels_painted = canvas.count_painted()
+            if pixels_painted / (end_index - start_index) ** 2 < config.min_coverage:
+                rejection = "min_coverage"
+        if rejection is None:
             break
+        if counters is not None:
+            counters.reject(rejection)
+        if geometry is not None:
+            geometry.reset()
+    else:
+        if counters is not None:
+            counters.accepted = False
+        raise RejectedImageError(f"No image met the acceptance criteria in {config.max_attempts} attempts, they are too strict for these parameters")
 
-    # Get the tortuous points
-    tortuous_points = []
-    for w in walkers:
-        if w.tortuous:
-            tortuous_points += w.get_tortuous_points()
-
-    tortuous_points = sum([list(point_set) for point_set in tortuous_points], [])
-    tortuous_points = list(set(tortuous_points))
-
-    # # Calculate the bounding box for the tortuous regions
-    # bounding_box_coords = []
-    # for points_set in tortuous_points:
-    #     max_x = max([p[0] for p in points_set])
-    #     max_x = bound(GRID_SIZE, math.floor(max_x + GRID_SIZE * 0.01))
-    #     min_x = min([p[0] for p in points_set])
-    #     min_x = bound(GRID_SIZE, math.floor(min_x - GRID_SIZE * 0.01))
-
-    #     max_y = max([p[1] for p in points_set])
-    #     max_y = bound(GRID_SIZE, math.floor(max_y + GRID_SIZE * 0.01))
-    #     min_y = min([p[1] for p in points_set])
-    #     min_y = bound(GRID_SIZE, math.floor(min_y - GRID_SIZE * 0.01))
-
-    #     # Uncomment to draw the bounding box
-    #     for x in range(min_x, max_x + 1):
-    #         img[x][min_y] = [255, 0, 0]
-    #         img[x][max_y] = [255, 0, 0]
-        
-    #     for y in range(min_y, max_y + 1):
-    #         img[min_x][y] = [255, 0, 0]
-    #         img[max_x][y] = [255, 0, 0]
-    #     bounding_box_coords.append([(min_x, min_y), (max_x, max_y)])
-
-    # Write the image to a file
-    img = np.array(img, dtype=np.uint8)
-
-    # Crop out the edges
-    start_index = int(GRID_SIZE * 0.2)
-    end_index = int(GRID_SIZE * 0.8)
-    img = img[start_index:end_index, start_index:end_index]
+    # The canvas only holds the window, the edges are never painted
+    # The canvas is single channel, the saved images stay 3 channel as before
+    img = canvas.image(grayscale)
+    clock.lap("rendering")
+    if stats is not None:
+        stats.pixels_painted = pixels_painted if pixels_painted is not None else canvas.count_painted()
+
+    if annotation != "points":
+        annotation = compact_annotation(tortuous_point_sets, annotation, config.grid_size, start_index, end_index)
+        clock.lap("annotation")
+        return img, annotation
+
+    if tortuous_points is None:
+        tortuous_points = window_tortuous_points(tortuous_point_sets, start_index, end_index)
+    clock.lap("annotation")
+
+    return img, tortuous_points
+
+def window_tortuous_points(tortuous_point_sets, start_index, end_index):
+    """The distinct tortuous points inside the window [start_index, end_index), in window coordinates."""
+    tortuous_points = list(set(itertools.chain.from_iterable(
+        map(tuple, point_set.tolist()) if isinstance(point_set, np.ndarray) else point_set
+        for point_set in tortuous_point_sets
+    )))
 
     # Remove the corresponding tortuous points and fix the coordinates to adjust for the cropping
-    tortuous_points = [
+    return [
         (x-start_index, y-start_index) for x, y in tortuous_points 
         if start_index <= x < end_index and start_index <= y < end_index
     ]
 
+def image_rng(base_seed, index):
+    """
+    Random generator of the image at global index `index` of a run.
+    Does not depend on which worker generates the image or when, so any image can be rebuilt from (base_seed, index) alone.
+    """
+    return np.random.default_rng([base_seed, index])
 
-    img = Image.fromarray(img)
+def mask_filename(filename):
+    """images/<class>/<i>.png -> images/masks/<class>/<i>.png"""
+    directory, name = os.path.split(filename)
+    root, class_directory = os.path.split(directory)
+    return os.path.join(root, "masks", class_directory, name)
 
-    return img, tortuous_points
+def manifest_columns(annotation, output_format = "png"):
+    columns = ["filename", "tortuous"]
+    if output_format == "npy":
+        columns.insert(1, "offset")
+    if annotation == "points":
+        columns.append("tortuous_points")
+    if "mask" in annotation:
+        columns.append("mask_filename")
+    if "boxes" in annotation:
+        columns.append("boxes")
+    return columns
 
-DEBUG = 0
-if DEBUG:
-    img, _ = generate_image(True)
-    img.save("tortuous.png")
-
-    img, _ = generate_image(False)
-    img.save("non_tortuous.png")
-else:
-    shutil.rmtree("images", ignore_errors=True)
-    os.makedirs("images/tortuous", exist_ok=True)
-    os.makedirs("images/non_tortuous", exist_ok=True)
-
-    start = datetime.datetime.now()
-    NUM_IMAGES_PER_CLASS = 1000
-    num_images = 0
-    files = {}
-
-    print("Generating Tortuous Images")
-    for i in tqdm.tqdm(range(NUM_IMAGES_PER_CLASS)):
-        img, tortuous_points = generate_image(True)
-        filename = f"images/tortuous/{i}.png"
-        files[num_images] = {
-            "filename": filename, 
-            "tortuous": 1,
-            "tortuous_points": tortuous_points
-        }
-        img.save(filename)
-        num_images += 1
-
-    print("Generating Non-Tortuous Images")
-    for i in tqdm.tqdm(range(NUM_IMAGES_PER_CLASS)):
-        img, tortuous_points = generate_image(False)
-        filename = f"images/non_tortuous/{i}.png"
-        files[num_images] = {
-            "filename": filename,
-            "tortuous": 0,
-            "tortuous_points": tortuous_points
+def render_indexed_image(task, annotation_mode = "points", shards = None, collect_stats = False, config = None):
+    """
+    Generate a single image of a run, without saving its PNGs.
+    Returns (index, manifest record, stats.ImageStats or None, the (image, filename) pairs still to be saved).
+    The record is None when no attempt met the acceptance criteria, the run then goes on without the image.
+    """
+    base_seed, index, tortuous_image, filename = task
+
+    stats = ImageStats() if collect_stats else None
+    try:
+        img, annotation = generate_image(
+            tortuous_image,
+            image_rng(base_seed, index),
+            annotation_mode,
+            grayscale = shards is not None,
+            stats = stats,
+            config = config
+        )
+    except RejectedImageError:
+        return index, None, stats, []
+    clock = PhaseClock(stats)
+    record = {"tortuous": int(tortuous_image)}
+    files = []
+    if shards is not None:
+        record["filename"], record["offset"] = shards.write(index, np.asarray(img))
+    else:
+        files.append((img, filename))
+        record["filename"] = filename
+    if annotation_mode == "points":
+        record["tortuous_points"] = annotation
+    if "mask" in annotation_mode:
+        record["mask_filename"] = mask_filename(filename)
+        # Saved as a 1 bit PNG
+        files.append((Image.fromarray(annotation["mask"] > 0), record["mask_filename"]))
+    if "boxes" in annotation_mode:
+        record["boxes"] = json.dumps(annotation["boxes"].tolist())
+    clock.lap("saving")
+    return index, record, stats, files
+
+def stats_record(index, record, stats):
+    """The stats.jsonl line of an image, None when the stats are not collected."""
+    if stats is None:
+        return None
+    return {"index": index, "filename": record["filename"] if record is not None else None, **stats.to_dict()}
+
+def generate_indexed_image(task, compress_level = PNG_COMPRESS_LEVEL, **options):
+    """
+    Generate and save a single image of a run. Runs in the worker processes when workers > 1.
+    task is (base_seed, index, tortuous_image, filename), options are passed to render_indexed_image.
+    """
+    index, record, stats, files = render_indexed_image(task, **options)
+    clock = PhaseClock(stats)
+    for img, filename in files:
+        save_image(img, filename, compress_level)
+    clock.lap("saving")
+    return index, record, stats_record(index, record, stats)
+
+def image_filename(directory, index, images_per_class):
+    # Tortuous images take the global indices [0, images_per_class), non-tortuous images the next images_per_class
+    if index < images_per_class:
+        return os.path.join(directory, "tortuous", f"{index}.png")
+    return os.path.join(directory, "non_tortuous", f"{index - images_per_class}.png")
+
+def image_shards(directory, config, shard_size, num_images, indices = None):
+    start_index, end_index = crop_window(config.grid_size, config.crop_window)
+    crop_size = end_index - start_index
+    shards = ShardWriter(os.path.join(directory, "shards"), shard_size, (crop_size, crop_size))
+    shards.create_shards(num_images, indices)
+    return shards
+
+def shard_indices(num_images, shard):
+    """
+    Global indices generated by shard (k, num_shards) of a run of num_images images: the k-th (from 0) of num_shards
+    contiguous ranges of near equal size. Only depends on its arguments, so every node finds its own range without coordination.
+    """
+    k, num_shards = shard
+    return range(k * num_images // num_shards, (k + 1) * num_images // num_shards)
+
+def shard_directory(directory, shard):
+    """Output directory of shard (k, num_shards) of the run in directory."""
+    k, num_shards = shard
+    return os.path.join(directory, f"shard-{k}-of-{num_shards}")
+
+def parse_shard(text):
+    """"k/N" -> (k, N)"""
+    try:
+        k, num_shards = (int(part) for part in text.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected k/N, got {text!r}")
+    if not 0 <= k < num_shards:
+        raise argparse.ArgumentTypeError(f"shard {k} does not exist in {num_shards} shards, k goes from 0 to N-1")
+    return k, num_shards
+
+def merge_shards(directory = "images", verbose = True):
+    """
+    Combine the finished shards of the run in directory (written by generate_dataset with a shard) into the data.csv
+    and run.json of the whole run. The images stay in the shard directories, data.csv refers to them there.
+    Raises ValueError unless the shards come from the same run and cover every image exactly once, the images left out
+    because they did not meet the acceptance criteria (failed_indices in the run.json of their shard) count as covered.
+    Returns the path of data.csv.
+    """
+    log = print if verbose else lambda *args: None
+    shard_directories = sorted(glob.glob(os.path.join(directory, "shard-*-of-*")))
+    if not shard_directories:
+        raise ValueError(f"No shards found in {directory}")
+
+    runs = []
+    for directory_of_shard in shard_directories:
+        if not run_finished(directory_of_shard):
+            raise ValueError(f"The shard in {directory_of_shard} is not finished, resume it first")
+        runs.append(ManifestWriter.read_run_info(directory_of_shard))
+    def shared_info(info):
+        return {key: value for key, value in info.items() if key not in ["shard", "failed_indices"]}
+    run_info = shared_info(runs[0])
+    for directory_of_shard, info in zip(shard_directories, runs):
+        if shared_info(info) != run_info:
+            raise ValueError(f"The shard in {directory_of_shard} is from another run (different seed, size or parameters)")
+    num_shards = runs[0]["shard"][1]
+    found_shards = sorted(tuple(info["shard"]) for info in runs)
+    if found_shards != [(k, num_shards) for k in range(num_shards)]:
+        raise ValueError(f"Expected the shards 0 to {num_shards - 1} of {num_shards}, found {found_shards}")
+
+    df = pd.concat([
+        pd.read_csv(os.path.join(directory_of_shard, "data.csv"), sep="\t", keep_default_na=False)
+        for directory_of_shard in shard_directories
+    ])
+    num_images = run_info["images_per_class"] * 2
+    duplicated = df["index"][df["index"].duplicated()]
+    if len(duplicated):
+        raise ValueError(f"{len(duplicated)} images are in more than one shard, e.g. index {duplicated.min()}")
+    failed = sorted(index for info in runs for index in info.get("failed_indices", []))
+    missing = set(range(num_images)) - set(df["index"]) - set(failed)
+    if missing:
+        raise ValueError(f"{len(missing)} images are missing from the shards, e.g. index {min(missing)}")
+    if failed:
+        log(
+            f"{len(failed)} images did not meet the acceptance criteria and are not in data.csv: " +
+            f"indices {failed[:10]}{' ...' if len(failed) > 10 else ''}"
+        )
+
+    manifest_path = os.path.join(directory, "data.csv")
+    df = df.sort_values("index").drop(columns="index")
+    atomic_write(manifest_path, lambda path: df.to_csv(path, index=False, sep="\t"))
+    write_run_info(directory, {**run_info, "shards": num_shards, "failed_indices": failed})
+    return manifest_path
+
+def bounded_imap_unordered(pool, work, tasks, max_in_flight):
+    """
+    pool.imap_unordered(work, tasks), but with at most max_in_flight tasks submitted whose result has not been taken yet,
+    so that the results do not pile up in this process when it consumes them slower than the workers produce them.
+    """
+    done = queue.Queue()
+    tasks = iter(tasks)
+    in_flight = 0
+    def submit(count):
+        nonlocal in_flight
+        for task in itertools.islice(tasks, count):
+            pool.apply_async(work, (task,), callback=lambda result: done.put((True, result)), error_callback=lambda error: done.put((False, error)))
+            in_flight += 1
+    submit(max_in_flight)
+    while in_flight:
+        success, result = done.get()
+        in_flight -= 1
+        if not success:
+            raise result
+        submit(1)
+        yield result
+
+def generate_dataset(
+        config,
+        n,
+        directory = "images",
+        seed = None,
+        workers = 1,
+        annotation = "points",
+        output_format = "png",
+        shard_size = 1000,
+        collect_stats = False,
+        resume = False,
+        verbose = True,
+        writer_threads = 0,
+        compress_level = PNG_COMPRESS_LEVEL,
+        shard = None
+    ):
+    """
+    Generate a dataset of n tortuous and n non-tortuous images with the parameters in config (a GeneratorConfig),
+    in this process (and workers - 1 others). Returns the path of the data.csv manifest.
+
+    The images of a run only depend on (seed, global index), seed is random if not given.
+    annotation is one of annotations.ANNOTATION_MODES, output_format "png" or "npy" (memory-mapped shards of shard_size images).
+    collect_stats also writes the per image stats.ImageStats to stats.jsonl.
+    With acceptance criteria in config, the share of rejected attempts (the wasted simulations) is logged at the end,
+    along with the images left out of data.csv because all their config.max_attempts attempts were rejected
+    (recorded as failed_indices in run.json).
+    resume continues the interrupted run in directory with its own seed, size and config, otherwise directory is wiped first.
+    writer_threads > 0 encodes and saves the PNGs in that many background threads of this process while the next images
+    are generated (the generating processes then only send the images back, with at most 2 * workers tasks in flight),
+    compress_level is the PNG zlib level.
+    shard = (k, num_shards) only generates the images of shard_indices(2 * n, shard), in shard_directory(directory, shard)
+    with a data.csv that keeps the global index column. Every shard needs the same seed, merge_shards then combines them.
+    """
+    log = print if verbose else lambda *args: None
+    if shard is not None:
+        directory = shard_directory(directory, shard)
+    manifest_path = os.path.join(directory, "data.csv")
+    if resume and run_finished(directory):
+        log(f"The run in {directory} is already finished, nothing to resume")
+        return manifest_path
+    if not resume:
+        shutil.rmtree(directory, ignore_errors=True)
+    os.makedirs(directory, exist_ok=True)
+
+    run_info = ManifestWriter.read_run_info(directory) if resume else None
+    if run_info is not None:
+        # The resumed images have to come from the same seeds as the finished ones
+        if seed is not None and seed != run_info["base_seed"]:
+            raise ValueError(f"seed {seed} does not match the seed {run_info['base_seed']} of the run being resumed")
+        seed = run_info["base_seed"]
+        n = run_info["images_per_class"]
+        annotation = run_info.get("annotation", "points")
+        output_format = run_info.get("format", "png")
+        shard_size = run_info.get("shard_size", shard_size)
+        if "config" in run_info:
+            config = GeneratorConfig.from_dict(run_info["config"])
+    elif seed is None:
+        if shard is not None:
+            raise ValueError("the shards of a run need its seed")
+        seed = np.random.SeedSequence().entropy
+    log(f"Base seed = {seed}")
+
+    manifest = ManifestWriter(directory, columns=manifest_columns(annotation, output_format), resume=resume)
+    if run_info is None:
+        run_info = {
+            "base_seed": seed,
+            "images_per_class": n,
+            "annotation": annotation,
+            "format": output_format,
+            "shard_size": shard_size,
+            "config": config.to_dict()
         }
-        img.save(filename)
-        num_images += 1
+        if shard is not None:
+            run_info["shard"] = list(shard)
+        manifest.write_run_info(run_info)
+
+    for class_directory in ["tortuous", "non_tortuous"]:
+        if output_format == "png":
+            os.makedirs(os.path.join(directory, class_directory), exist_ok=True)
+        if "mask" in annotation:
+            os.makedirs(os.path.join(directory, "masks", class_directory), exist_ok=True)
+
+    indices = shard_indices(n * 2, shard) if shard is not None else range(n * 2)
+    shards = image_shards(directory, config, shard_size, n * 2, indices) if output_format == "npy" else None
+
+    tasks = [(seed, index, index < n, image_filename(directory, index, n)) for index in indices]
+    if resume:
+        finished = manifest.finished_indices()
+        tasks = [task for task in tasks if task[1] not in finished]
+        log(f"Resuming, {len(finished)} images already finished")
 
-    df = pd.DataFrame.from_dict(files, orient="index")
-    df.to_csv("images/data.csv", index=False, sep="\t")
+    stats_file = open(os.path.join(directory, "stats.jsonl"), "a" if resume else "w") if collect_stats else None
+    # With acceptance criteria the stats are always collected, to report how many attempts were rejected
+    rejections = dict.fromkeys(REJECTION_REASONS, 0) if config.has_acceptance_criteria() else None
+    # Images whose attempts were all rejected are left out of the manifest instead of stopping the run
+    failed = []
+    def write_result(index, record, stats):
+        if record is not None:
+            manifest.append(index, record)
+        else:
+            failed.append(index)
+        if rejections is not None:
+            for reason in REJECTION_REASONS:
+                rejections[reason] += stats[f"rejected_{reason}"]
+        if stats_file is not None:
+            stats_file.write(json.dumps(stats) + "\n")
+            stats_file.flush()
 
-    end = datetime.datetime.now()
-    print(f"Time taken = {end-start} to generate {NUM_IMAGES_PER_CLASS * 2} images")
\ No newline at end of file
+    options = {
+        "annotation_mode": annotation,
+        "shards": shards,
+        "collect_stats": collect_stats or rejections is not None,
+        "config": config
+    }
+    if writer_threads > 0:
+        work = functools.partial(render_indexed_image, **options)
+    else:
+        work = functools.partial(generate_indexed_image, compress_level=compress_level, **options)
+
+    log(f"Generating {len(tasks)} Images with {workers} worker(s)")
+    pool = multiprocessing.Pool(workers) if workers > 1 else None
+    try:
+        # The manifest is sorted by index when finalized, so the images can finish in any order
+        if pool is None:
+            results = map(work, tasks)
+        elif writer_threads > 0:
+            # The workers send the images back, only a few may wait here on top of the writer queue
+            results = bounded_imap_unordered(pool, work, tasks, 2 * workers)
+        else:
+            results = pool.imap_unordered(work, tasks)
+        results = tqdm.tqdm(results, total=len(tasks), disable=not verbose)
+        if writer_threads > 0:
+            background_writer = BackgroundWriter(writer_threads, compress_level=compress_level)
+            def write_saved(saved):
+                # Only the images that are on disk go in the manifest
+                for (index, record, stats), seconds in saved:
+                    if stats is not None:
+                        stats.add_time("saving", seconds)
+                    write_result(index, record, stats_record(index, record, stats))
+            try:
+                for index, record, stats, files in results:
+                    background_writer.submit(files, (index, record, stats))
+                    write_saved(background_writer.completed())
+            finally:
+                write_saved(background_writer.close())
+        else:
+            for result in results:
+                write_result(*result)
+    finally:
+        if pool is not None:
+            pool.terminate()
+    if shards is not None:
+        shards.close()
+    # Written before data.csv, so that every finished run records them (merge_shards counts them as covered)
+    failed.sort()
+    manifest.write_run_info({**run_info, "failed_indices": failed})
+    manifest.finalize(keep_index = shard is not None)
+    if rejections is not None and tasks:
+        accepted = len(tasks) - len(failed)
+        attempts = accepted + sum(rejections.values())
+        log(
+            f"Accepted {accepted} of {attempts} attempts ({accepted / attempts:.1%}), rejected: " +
+            ", ".join(f"{count} {reason}" for reason, count in rejections.items())
+        )
+    if failed:
+        log(
+            f"{len(failed)} images did not meet the acceptance criteria in {config.max_attempts} attempts and are not in data.csv: " +
+            f"indices {failed[:10]}{' ...' if len(failed) > 10 else ''}"
+        )
+    if stats_file is not None:
+        stats_file.close()
+    return manifest_path
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate the synthetic tortuosity dataset")
+    parser.add_argument("--workers", type=int, default=1, help="Number of processes generating images")
+    parser.add_argument("--seed", type=int, default=None, help="Base seed of the run. Random if not given")
+    parser.add_argument("--images-per-class", type=int, default=1000)
+    parser.add_argument("--config", default=None, help="JSON file of generator parameters overriding config.py (config.py or GeneratorConfig names)")
+    parser.add_argument("--index", type=int, default=None, help="Only regenerate the image at this global index of the run given by --seed")
+    parser.add_argument("--resume", action="store_true", help="Continue an interrupted run, only generating the missing images")
+    parser.add_argument(
+        "--format",
+        choices=["png", "npy"],
+        default="png",
+        help="png: one 3 channel PNG per image. npy: single channel images in memory-mapped .npy shards (images/shards/), data.csv gives the shard and offset of each image"
+    )
+    parser.add_argument("--shard-size", type=int, default=1000, help="Number of images per .npy shard")
+    parser.add_argument("--writer-threads", type=int, default=0, help="Threads encoding and saving the PNGs in the background while the next images are generated. 0 saves them in the generating processes")
+    parser.add_argument("--compress-level", type=int, choices=range(10), default=PNG_COMPRESS_LEVEL, help="PNG zlib compression level, 0 (fastest) to 9 (smallest)")
+    parser.add_argument(
+        "--shard",
+        type=parse_shard,
+        default=None,
+        help="k/N: only generate shard k (0 to N-1) of the run into images/shard-k-of-N/, to split a run across machines. Needs --seed, the same on every machine"
+    )
+    parser.add_argument("--merge-shards", action="store_true", help="Check that the finished shards in images/ cover the whole run and combine their manifests into images/data.csv")
+    parser.add_argument("--stats", action="store_true", help="Write per image generation statistics and phase timings to images/stats.jsonl")
+    parser.add_argument(
+        "--annotation",
+        choices=ANNOTATION_MODES,
+        default="points",
+        help="Tortuosity annotation: the list of tortuous points in data.csv, or a binary mask image per image (images/masks/) and/or per-segment bounding boxes"
+    )
+    args = parser.parse_args()
+
+    config = GeneratorConfig()
+    if args.config is not None:
+        with open(args.config) as f:
+            try:
+                config = GeneratorConfig.from_dict(json.load(f), strict=True)
+            except ValueError as error:
+                parser.error(f"{args.config}: {error}")
+
+    if args.merge_shards:
+        try:
+            manifest_path = merge_shards("images")
+        except ValueError as error:
+            parser.error(str(error))
+        print(f"Merged the shards into {manifest_path}")
+    elif args.index is not None:
+        # Regenerate into the layout of the existing run if there is one
+        directory = shard_directory("images", args.shard) if args.shard is not None else "images"
+        run_info = ManifestWriter.read_run_info(directory) or {}
+        base_seed = args.seed if args.seed is not None else run_info.get("base_seed")
+        if base_seed is None:
+            parser.error("--index needs the --seed of the run")
+        if "config" in run_info:
+            config = GeneratorConfig.from_dict(run_info["config"])
+        NUM_IMAGES_PER_CLASS = run_info.get("images_per_class", args.images_per_class)
+        annotation = run_info.get("annotation", args.annotation)
+        if "shards" in run_info:
+            # Merged sharded run, the image goes back to the directory of its shard
+            num_shards = run_info["shards"]
+            directory = next((
+                shard_directory(directory, (k, num_shards)) for k in range(num_shards)
+                if args.index in shard_indices(NUM_IMAGES_PER_CLASS * 2, (k, num_shards))
+            ), directory)
+        tortuous_image = args.index < NUM_IMAGES_PER_CLASS
+        filename = image_filename(directory, args.index, NUM_IMAGES_PER_CLASS)
+        shards = None
+        if run_info.get("format", args.format) == "npy":
+            shards = image_shards(
+                directory,
+                config,
+                run_info.get("shard_size", args.shard_size),
+                NUM_IMAGES_PER_CLASS * 2,
+                range(args.index, args.index + 1)
+            )
+        else:
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+        if "mask" in annotation:
+            os.makedirs(os.path.dirname(mask_filename(filename)), exist_ok=True)
+        _, record, _ = generate_indexed_image(
+            (base_seed, args.index, tortuous_image, filename),
+            annotation_mode = annotation,
+            shards = shards,
+            config = config
+        )
+        if shards is not None:
+            shards.close()
+        if record is None:
+            print(f"Image {args.index} did not meet the acceptance criteria in {config.max_attempts} attempts")
+        else:
+            print(f"Regenerated image {args.index} in {record['filename']}")
+    else:
+        start = datetime.datetime.now()
+        try:
+            generate_dataset(
+                config,
+                args.images_per_class,
+                seed = args.seed,
+                workers = args.workers,
+                annotation = args.annotation,
+                output_format = args.format,
+                shard_size = args.shard_size,
+                collect_stats = args.stats,
+                resume = args.resume,
+                writer_threads = args.writer_threads,
+                compress_level = args.compress_level,
+                shard = args.shard
+            )
+        except ValueError as error:
+            parser.error(str(error))
+        end = datetime.datetime.now()
+        print(f"Time taken = {end-start}")
@@ -0,0 +1,299 @@
+import numpy as np
+
+from generator_config import GeneratorConfig
+from random_stream import random_stream
+from util import damped_sine
+from vector_field import static_directions, normalize_vectors
+
+def rotate_vectors(x, y, angles):
+    """Vectorized rotate_vector, angles in degrees."""
+    angle_rads = np.radians(angles)
+    cos, sin = np.cos(angle_rads), np.sin(angle_rads)
+    return x * cos - y * sin, x * sin + y * cos
+
+def bound_many(grid_size, values):
+    """Vectorized bound."""
+    return np.where(values < 0, 0, np.where(values >= grid_size, grid_size - 1, values))
+
+class WalkerPopulation:
+    """
+    Structure of arrays alternative to the recursive Walker tree.
+
+    Every live walker is a row of flat arrays (position, direction, width, moves, max moves,
+    reproduction probability, tortuous flag, parent id). All of them are advanced together once per tick
+    with the same rules as Walker.move, dead walkers are dropped and newborn walkers are appended in bulk.
+    The random draws happen in a different order than in the tree, so the images differ from the tree engine's
+    for the same seed but follow the same distribution.
+    """
+    FIELDS = [
+        "x", "y", "direction_x", "direction_y", "width", "moves", "max_moves",
+        "reproduction_probability", "tortuous", "root", "walker_id", "parent_id", "depth"
+    ]
+
+    def __init__(self, canvas, grid_size, source_point, rng, vector_field = None, stats = None, config = None, geometry = None):
+        self.canvas = canvas
+        # Optional geometry.GeometryRecorder recording the strokes of every walker
+        self.geometry = geometry
+        self.config = config if config is not None else GeneratorConfig()
+        # Optional stats.ImageStats counting the walkers and their moves
+        self.stats = stats
+        self.grid_size = grid_size
+        self.source_point = source_point
+        self.rng = rng
+        # Random decisions of the moves, see random_stream
+        self.random = random_stream(rng, grid_size, self.config)
+        self.vector_field = vector_field
+
+        self.x = np.empty(0)
+        self.y = np.empty(0)
+        self.direction_x = np.empty(0)
+        self.direction_y = np.empty(0)
+        self.width = np.empty(0)
+        self.moves = np.empty(0, dtype=np.int64)
+        self.max_moves = np.empty(0)
+        self.reproduction_probability = np.empty(0)
+        self.tortuous = np.empty(0, dtype=bool)
+        self.root = np.empty(0, dtype=bool)
+        self.walker_id = np.empty(0, dtype=np.int64)
+        self.parent_id = np.empty(0, dtype=np.int64)
+        self.depth = np.empty(0, dtype=np.int64)
+
+        self.num_spawned = 0
+        self.tortuous_point_sets = []
+
+    def __len__(self):
+        return len(self.x)
+
+    def add_walkers(
+            self,
+            x,
+            y,
+            direction_x,
+            direction_y,
+            tortuous,
+            reproduction_probability,
+            width = None,
+            moves = 0,
+            max_moves = None,
+            parent_id = -1,
+            depth = 0
+        ):
+        """Append a batch of walkers. Scalars are broadcast over the batch, walkers without a parent are roots."""
+        x = np.atleast_1d(np.asarray(x, dtype=np.float64))
+        count = len(x)
+        if width is None:
+            width = self.grid_size * self.config.walker_initial_path_width
+        if max_moves is None:
+            max_moves = self.config.max_moves
+        parent_id = np.broadcast_to(np.asarray(parent_id, dtype=np.int64), (count,))
+        walker_id = np.arange(self.num_spawned, self.num_spawned + count)
+        if self.geometry is not None:
+            walker_id = np.array([self.geometry.add_walker(parent) for parent in parent_id.tolist()], dtype=np.int64)
+
+        new_values = {
+            "x": x,
+            "y": y,
+            "direction_x": direction_x,
+            "direction_y": direction_y,
+            "width": width,
+            "moves": moves,
+            "max_moves": max_moves,
+            "reproduction_probability": reproduction_probability,
+            "tortuous": tortuous,
+            "root": parent_id < 0,
+            "walker_id": walker_id,
+            "parent_id": parent_id,
+            "depth": depth,
+        }
+        for field, values in new_values.items():
+            current = getattr(self, field)
+            values = np.broadcast_to(np.asarray(values, dtype=current.dtype), (count,))
+            setattr(self, field, np.concatenate((current, values)))
+        self.num_spawned += count
+        if self.stats is not None:
+            self.stats.walkers_born(count, np.max(depth))
+
+    def run(self, abort = None):
+        """
+        Move the walkers until they all die.
+        Like the tree engine's loop in generate_image, the simulation stops once all the root walkers are dead:
+        the children still alive then get one last tick.
+        abort: optional function called after every tick, the simulation is abandoned when it returns True.
+        Returns False if it was abandoned.
+        """
+        while len(self):
+            roots_alive = self.root.any()
+            self.tick()
+            if abort is not None and abort():
+                return False
+            if not roots_alive:
+                break
+        return True
+
+    def tick(self):
+        count = len(self)
+        self.moves += 1
+        dead = np.zeros(count, dtype=bool)
+
+        tortuous_move = self.tortuous & (self.random.random(count) <= self.config.tortuous_probability)
+        tortuous_indices = np.flatnonzero(tortuous_move)
+        if self.stats is not None:
+            self.stats.total_moves += count
+            self.stats.tortuous_segments += len(tortuous_indices)
+        if len(tortuous_indices):
+            first_points = self.make_sine_moves(tortuous_indices, dead)
+            second_points = self.make_sine_moves(tortuous_indices, dead)
+            for first, second in zip(first_points, second_points):
+                self.tortuous_point_sets.append(np.concatenate((first, second)))
+
+        normal_move = ~tortuous_move
+        for _ in range(3):
+            # Like make_small_move_straight, walkers that died earlier in the move stop moving
+            moving = np.flatnonzero(normal_move & ~dead)
+            if len(moving):
+                self.make_small_moves(moving, dead)
+
+        newborns = self.reproduce()
+        dead |= self.moves > self.max_moves
+
+        alive = ~dead
+        for field in self.FIELDS:
+            setattr(self, field, getattr(self, field)[alive])
+        if newborns is not None:
+            self.add_walkers(**newborns)
+
+    def get_directions(self, indices):
+        """Vectorized Walker.get_direction for the walkers at indices."""
+        x, y = self.x[indices], self.y[indices]
+        if self.vector_field is not None:
+            static_x, static_y = self.vector_field.lookup_many(x, y)
+        else:
+            static_x, static_y = static_directions(
+                self.source_point, self.grid_size, x, y,
+                sink_strength = self.config.sink_strength,
+                vector_field_weight = self.config.vector_field_weight,
+                middle_line_weight = self.config.middle_line_weight
+            )
+        momentum_weight = 1 - self.config.vector_field_weight - self.config.middle_line_weight
+        return normalize_vectors(
+            static_x + self.direction_x[indices] * momentum_weight,
+            static_y + self.direction_y[indices] * momentum_weight
+        )
+
+    def turn(self, indices):
+        """Point the walkers along the field direction, turned by a small random angle."""
+        turn_angles = self.random.small_angles(len(indices))
+        direction_x, direction_y = rotate_vectors(*self.get_directions(indices), turn_angles)
+        self.direction_x[indices] = direction_x
+        self.direction_y[indices] = direction_y
+        return direction_x, direction_y
+
+    def decayed_widths(self, indices, num_steps):
+        """
+        Widths of the walkers at each of their next steps, decayed like Walker.width_decay_steps.
+        Returns an array with one more column than the steps: the width after the last step.
+        """
+        widths = np.full((len(indices), num_steps + 1), 1 - self.config.walker_path_width_decay)
+        widths[:, 0] = self.width[indices]
+        return np.multiply.accumulate(widths, axis=1)
+
+    def check_bounds(self, indices, dead):
+        x, y = self.x[indices], self.y[indices]
+        dead[indices] |= (x >= self.grid_size - 1) | (y >= self.grid_size - 1) | (x <= 0) | (y <= 0)
+
+    def make_small_moves(self, indices, dead):
+        """Vectorized Walker.make_small_move_straight."""
+        direction_x, direction_y = self.turn(indices)
+        movement_lengths = self.random.small_movement_lengths(len(indices))
+
+        x, y = self.x[indices], self.y[indices]
+        step_x = (bound_many(self.grid_size, x + direction_x * movement_lengths) - x) / movement_lengths
+        step_y = (bound_many(self.grid_size, y + direction_y * movement_lengths) - y) / movement_lengths
+
+        max_steps = movement_lengths.max()
+        xs = np.empty((len(indices), max_steps + 1))
+        ys = np.empty((len(indices), max_steps + 1))
+        xs[:, 0], ys[:, 0] = x, y
+        xs[:, 1:] = step_x[:, None]
+        ys[:, 1:] = step_y[:, None]
+        np.add.accumulate(xs, axis=1, out=xs)
+        np.add.accumulate(ys, axis=1, out=ys)
+        widths = self.decayed_widths(indices, max_steps)
+
+        # Every walker paints one stroke per step of its own movement length
+        valid = np.arange(1, max_steps + 1)[None, :] <= movement_lengths[:, None]
+        rows = np.repeat(np.arange(len(indices)), movement_lengths)
+        centers = np.stack((xs[:, 1:][valid], ys[:, 1:][valid]), axis=-1)
+        directions = np.stack((direction_x[rows], direction_y[rows]), axis=-1)
+        self.canvas.stamp_perpendicular(centers, directions, widths[:, :-1][valid])
+        if self.geometry is not None:
+            self.geometry.add_vertices(self.walker_id[indices][rows], centers, directions, widths[:, :-1][valid], False)
+
+        last = np.arange(len(indices))
+        self.x[indices] = xs[last, movement_lengths]
+        self.y[indices] = ys[last, movement_lengths]
+        self.width[indices] = widths[last, movement_lengths]
+        self.check_bounds(indices, dead)
+
+    def make_sine_moves(self, indices, dead):
+        """Vectorized Walker.make_tortuous_move, returns the (360, 2) points of each walker."""
+        direction_x, direction_y = self.turn(indices)
+        wavelengths = self.random.movement_lengths(len(indices))
+        amplitudes = wavelengths / 2
+
+        total_angle = 360
+        angles = np.arange(1, total_angle + 1)[None, :]
+        step_lengths = (wavelengths / total_angle)[:, None]
+        perpendicular_x, perpendicular_y = rotate_vectors(direction_x, direction_y, 90)
+
+        offsets = damped_sine(angles, amplitudes[:, None], t=self.moves[indices][:, None])
+        xs = self.x[indices][:, None] + direction_x[:, None] * angles * step_lengths + offsets * perpendicular_x[:, None]
+        ys = self.y[indices][:, None] + direction_y[:, None] * angles * step_lengths + offsets * perpendicular_y[:, None]
+        widths = self.decayed_widths(indices, total_angle)
+
+        centers = np.stack((xs.ravel(), ys.ravel()), axis=-1)
+        directions = np.stack((np.repeat(direction_x, total_angle), np.repeat(direction_y, total_angle)), axis=-1)
+        self.canvas.stamp_perpendicular(centers, directions, widths[:, :-1].ravel())
+        if self.geometry is not None:
+            self.geometry.add_vertices(np.repeat(self.walker_id[indices], total_angle), centers, directions, widths[:, :-1].ravel(), True)
+
+        self.x[indices] = xs[:, -1]
+        self.y[indices] = ys[:, -1]
+        self.width[indices] = widths[:, -1]
+        self.check_bounds(indices, dead)
+        return np.stack((xs, ys), axis=-1)
+
+    def reproduce(self):
+        """Vectorized Walker.try_reproduce. Returns the newborn walkers to append after the tick, or None."""
+        reproduction_probability = np.where(
+            self.tortuous,
+            self.reproduction_probability * self.config.tortuous_reproduction_probability_multiplier,
+            self.reproduction_probability
+        )
+        draws = self.random.random(len(self))
+        parents = np.flatnonzero((self.moves >= self.config.walker_maturity_steps) & (draws < reproduction_probability))
+        if len(parents) == 0:
+            return None
+
+        direction_x, direction_y = rotate_vectors(
+            self.direction_x[parents],
+            self.direction_y[parents],
+            self.random.large_angles(len(parents))
+        )
+        return {
+            "x": self.x[parents],
+            "y": self.y[parents],
+            "direction_x": direction_x,
+            "direction_y": direction_y,
+            "tortuous": self.tortuous[parents],
+            "reproduction_probability": self.reproduction_probability[parents] * self.config.walker_child_reproduction_probability_multiplier,
+            "width": self.width[parents] * self.config.walker_child_path_width_multiplier,
+            "moves": self.moves[parents],
+            "max_moves": self.max_moves[parents] * self.config.walker_child_max_moves_multiplier,
+            "parent_id": self.walker_id[parents],
+            "depth": self.depth[parents] + 1,
+        }
+
+    def get_tortuous_points(self):
+        """Same format as Walker.get_tortuous_points: one set of (x, y) points per tortuous move."""
+        return [set(map(tuple, point_set.tolist())) for point_set in self.tortuous_point_sets]
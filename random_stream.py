@@ -0,0 +1,111 @@
+import math
+import numpy as np
+
+class DirectRandom:
+    """
+    The random decisions of the walkers (move kind, reproduction, turn angles and movement lengths), drawn from rng
+    one call at a time with the rejection loops of the original code, so the images are the ones generated before
+    the buffered stream for the same seed.
+    Every method returns a single value, or an array of count values for the population engine.
+    """
+    def __init__(self, rng, grid_size, config):
+        self.rng = rng
+        self.angle_lower_bound = config.angle_lower_bound
+        self.angle_upper_bound = config.angle_upper_bound
+        self.max_movement_length = math.floor((grid_size - 1) * config.movement_length_limiter)
+        self.tortuous_movement_length_limiter = config.tortuous_movement_length_limiter
+
+    def random(self, count = None):
+        return self.rng.random(count)
+
+    def small_angles(self, count = None):
+        return self.rng.integers(-self.angle_lower_bound, self.angle_lower_bound + 1, count)
+
+    def large_angles(self, count = None):
+        return self.rng.choice(
+            list(range(self.angle_lower_bound, self.angle_upper_bound)) +
+            list(range(-self.angle_upper_bound, -self.angle_lower_bound)),
+            count
+        )
+
+    def movement_lengths(self, count = None):
+        return self.rng.integers(1, self.max_movement_length + 1, count)
+
+    def small_movement_lengths(self, count = None):
+        if count is None:
+            dist = 0
+            while dist == 0:
+                dist = math.floor(self.movement_lengths() * self.tortuous_movement_length_limiter)
+            return dist
+        lengths = np.zeros(count, dtype=np.int64)
+        redraw = np.arange(count)
+        while len(redraw):
+            lengths[redraw] = np.floor(self.movement_lengths(len(redraw)) * self.tortuous_movement_length_limiter)
+            redraw = redraw[lengths[redraw] == 0]
+        return lengths
+
+def buffered_values(sample, block_size):
+    """Endless iterator over the values of sample(block_size) blocks, as Python numbers."""
+    while True:
+        yield from sample(block_size).tolist()
+
+class BufferedRandom:
+    """
+    Same decisions as DirectRandom, but every kind of value is drawn from rng in blocks of block_size and handed out
+    one at a time, instead of a generator call per value.
+    The rejection loops are replaced by sampling directly from their distributions: the small movement lengths are
+    drawn uniformly from the table of the lengths the loop accepts, which gives each of them the same probability.
+    The values only depend on the order of the requests, so the images are reproducible for a seed,
+    but differ from the DirectRandom ones.
+    """
+    def __init__(self, rng, grid_size, config, block_size = 1024):
+        self.rng = rng
+        max_movement_length = math.floor((grid_size - 1) * config.movement_length_limiter)
+        if max_movement_length < 1:
+            raise ValueError(f"movement_length_limiter {config.movement_length_limiter} leaves no movement length on a grid of {grid_size}")
+        small_lengths = np.floor(np.arange(1, max_movement_length + 1) * config.tortuous_movement_length_limiter).astype(np.int64)
+        self.small_movement_length_table = small_lengths[small_lengths > 0]
+        if len(self.small_movement_length_table) == 0:
+            raise ValueError(f"tortuous_movement_length_limiter {config.tortuous_movement_length_limiter} leaves no small movement length on a grid of {grid_size}")
+        self.large_angle_table = np.concatenate((
+            np.arange(config.angle_lower_bound, config.angle_upper_bound),
+            np.arange(-config.angle_upper_bound, -config.angle_lower_bound)
+        ))
+
+        self.samplers = {
+            "random": lambda size: rng.random(size),
+            "small_angles": lambda size: rng.integers(-config.angle_lower_bound, config.angle_lower_bound + 1, size),
+            "large_angles": lambda size: self.large_angle_table[rng.integers(0, len(self.large_angle_table), size)],
+            "movement_lengths": lambda size: rng.integers(1, max_movement_length + 1, size),
+            "small_movement_lengths": lambda size: self.small_movement_length_table[rng.integers(0, len(self.small_movement_length_table), size)],
+        }
+        self.values = {kind: buffered_values(sample, block_size) for kind, sample in self.samplers.items()}
+
+    def draw(self, kind, count):
+        # Arrays are drawn in one call already, only the single values are buffered
+        if count is not None:
+            return self.samplers[kind](count)
+        return next(self.values[kind])
+
+    def random(self, count = None):
+        return self.draw("random", count)
+
+    def small_angles(self, count = None):
+        return self.draw("small_angles", count)
+
+    def large_angles(self, count = None):
+        return self.draw("large_angles", count)
+
+    def movement_lengths(self, count = None):
+        return self.draw("movement_lengths", count)
+
+    def small_movement_lengths(self, count = None):
+        return self.draw("small_movement_lengths", count)
+
+RANDOM_STREAMS = {"direct": DirectRandom, "buffered": BufferedRandom}
+
+def random_stream(rng, grid_size, config):
+    """The random source selected by config.random_stream, drawing from rng."""
+    if config.random_stream not in RANDOM_STREAMS:
+        raise ValueError(f"Unknown random stream {config.random_stream!r}, expected one of {list(RANDOM_STREAMS)}")
+    return RANDOM_STREAMS[config.random_stream](rng, grid_size, config)
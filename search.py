@@ -0,0 +1,184 @@
+import os
+import json
+import hashlib
+import functools
+import multiprocessing
+import numpy as np
+import pandas as pd
+
+from main import generate_image, image_rng
+from generator_config import GeneratorConfig
+from geometry import GeometryRecorder
+from graph import vessel_graph
+from writer import atomic_write
+
+# Same thresholding as the skeleton analysis of the real images
+SMOOTH_RADIUS = 0.1
+THRESHOLD_RADIUS = 10
+
+def image_metrics(pixels):
+    """
+    Skeleton metrics of one single channel image (uint8 array): mean branch length, number of branches and branch type counts.
+    Needs scikit-image and skan, which are only imported here so that the generator itself does not depend on them.
+    """
+    from skimage import morphology
+    from skan import Skeleton, summarize
+    from skan.pre import threshold
+
+    binary = threshold(pixels, sigma=SMOOTH_RADIUS, radius=THRESHOLD_RADIUS)
+    skeleton = Skeleton(morphology.skeletonize(binary))
+    branch_data = summarize(skeleton)
+    return {
+        "mean_branch_length": branch_data["branch-distance"].mean(),
+        "num_branches": branch_data["branch-distance"].count(),
+        **{f"branch_types_{type}": freq for (type, freq) in branch_data["branch-type"].value_counts().to_dict().items()},
+    }
+
+def generated_image_metrics(tortuous_image, rng, config, source = "skeleton"):
+    """
+    Metrics of one generated image. source "skeleton" analyses the image like the real ones (needs scikit-image and skan),
+    "graph" reads them from the exact vessel graph of the simulation instead, which is much faster.
+    """
+    if source == "graph":
+        recorder = GeometryRecorder()
+        generate_image(tortuous_image, rng, grayscale=True, config=config, geometry=recorder)
+        return vessel_graph(recorder.geometry()).summary()
+    img, _ = generate_image(tortuous_image, rng, grayscale=True, config=config)
+    return image_metrics(np.asarray(img))
+
+def dataset_metrics(image_metrics_list):
+    """The metrics the search matches against the real images, averaged over the images."""
+    df = pd.DataFrame(image_metrics_list).fillna(0)
+    return [
+        float(df["mean_branch_length"].mean()),
+        float(df["num_branches"].mean()),
+    ]
+
+def metrics_error(metrics, original_metrics):
+    error = 0
+    for (m1, m2) in zip(metrics, original_metrics):
+        error += ((abs(m2 - m1)/abs(m1)) ** 2)
+    return error
+
+class MetricsCache:
+    """
+    On-disk memo of evaluate_metrics results, one small JSON file per evaluation in directory.
+
+    Entries are keyed by a hash of the generator config (normalized through GeneratorConfig, so the parameters the
+    generator does not use and the NumPy/Python number types do not matter), the seed, the image budget and the early
+    stopping settings. The files are written atomically, so the worker processes can share a cache and an interrupted
+    search keeps everything it finished. Beyond max_entries the least recently used entries are removed.
+    Bump VERSION when a change to the generator or the metrics makes the cached results stale.
+    """
+    VERSION = 1
+
+    def __init__(self, directory = "fitness_cache", max_entries = 10000):
+        self.directory = directory
+        self.max_entries = max_entries
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, params, n, seed, tolerance, check_every, source = "skeleton"):
+        config = params if isinstance(params, GeneratorConfig) else GeneratorConfig.from_dict(params)
+        description = {
+            "version": self.VERSION,
+            "config": config.to_dict(),
+            "n": n,
+            "seed": seed,
+            "tolerance": tolerance,
+            "check_every": check_every,
+            "source": source,
+        }
+        return hashlib.sha256(json.dumps(description, sort_keys=True).encode()).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+
+    def get(self, key):
+        path = self.path(key)
+        try:
+            with open(path) as f:
+                metrics = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        # Mark as recently used for the eviction
+        os.utime(path)
+        return metrics
+
+    def put(self, key, metrics):
+        def write(path):
+            with open(path, "w") as f:
+                json.dump(metrics, f)
+        atomic_write(self.path(key), write)
+        self.evict()
+
+    def evict(self):
+        entries = [entry for entry in os.scandir(self.directory) if entry.name.endswith(".json")]
+        if len(entries) <= self.max_entries:
+            return
+        entries.sort(key=lambda entry: entry.stat().st_mtime)
+        for entry in entries[:len(entries) - self.max_entries]:
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                # Already evicted by another worker
+                pass
+
+def evaluation_indices(n):
+    """
+    Global indices of the n tortuous and n non-tortuous images of a run (same seeds as generate_dataset),
+    alternating between the classes so that every prefix is balanced and can be stopped early.
+    """
+    for i in range(n):
+        yield i
+        yield n + i
+
+def evaluate_metrics(params, n = 100, seed = 0, tolerance = None, check_every = 20, cache = None, source = "skeleton"):
+    """
+    Generate up to n images per class with params (a GeneratorConfig or a dict accepted by GeneratorConfig.from_dict)
+    in memory and return their dataset metrics. Nothing is written to disk.
+
+    With a tolerance, generation stops early once the metrics change by less than that fraction between
+    two checks (every check_every images), the image budget is then only spent on the configs that need it.
+    cache: optional MetricsCache, repeated evaluations of the same config are then read back instead of regenerated.
+    source: where the metrics come from, see generated_image_metrics.
+    """
+    if cache is not None:
+        key = cache.key(params, n, seed, tolerance, check_every, source)
+        metrics = cache.get(key)
+        if metrics is not None:
+            return metrics
+
+    config = params if isinstance(params, GeneratorConfig) else GeneratorConfig.from_dict(params)
+    per_image = []
+    metrics = None
+    for index in evaluation_indices(n):
+        per_image.append(generated_image_metrics(index < n, image_rng(seed, index), config, source))
+
+        if tolerance is not None and len(per_image) % check_every == 0:
+            previous, metrics = metrics, dataset_metrics(per_image)
+            if previous is not None and all(
+                abs(current - last) <= tolerance * abs(last) for current, last in zip(metrics, previous)
+            ):
+                break
+    metrics = dataset_metrics(per_image)
+    if cache is not None:
+        cache.put(key, metrics)
+    return metrics
+
+def fitness_error(individual, original_metrics, n = 100, seed = 0, tolerance = None, check_every = 20, cache = None, source = "skeleton"):
+    """
+    DEAP fitness of an individual: the squared relative error of its dataset metrics against the original ones.
+    Every individual is evaluated on the same seed, so the differences between them come from the parameters only.
+    """
+    metrics = evaluate_metrics(individual, n, seed, tolerance, check_every, cache, source)
+    return metrics_error(metrics, original_metrics),
+
+def evaluate_population(individuals, original_metrics, workers = None, **kwargs):
+    """
+    Fitness of every individual, evaluated concurrently in a pool of workers processes (all the cores if None).
+    kwargs are passed to fitness_error.
+    """
+    evaluate = functools.partial(fitness_error, original_metrics=original_metrics, **kwargs)
+    # Plain dicts are sent to the workers, the DEAP individual classes only exist in the parent
+    with multiprocessing.Pool(workers) as pool:
+        return pool.map(evaluate, [dict(individual) for individual in individuals], chunksize=1)
@@ -0,0 +1,72 @@
+import time
+
+# Reasons an attempt at generating an image is rejected, see GeneratorConfig.has_acceptance_criteria
+REJECTION_REASONS = ["max_walkers", "min_tortuous_points", "min_coverage"]
+
+class ImageStats:
+    """
+    Per image counters and phase timings.
+    Pass one to generate_image to have it filled in by the walkers, the canvas and generate_image itself.
+    Nothing is counted or timed when no stats object is given.
+    """
+    def __init__(self):
+        self.walkers_spawned = 0
+        self.max_depth = 0
+        self.total_moves = 0
+        self.tortuous_segments = 0
+        self.pixels_painted = 0
+        self.phase_times = {}
+        self.rejections = dict.fromkeys(REJECTION_REASONS, 0)
+        # False when every attempt was rejected
+        self.accepted = True
+
+    def walkers_born(self, count, max_depth):
+        self.walkers_spawned += count
+        self.max_depth = max(self.max_depth, int(max_depth))
+
+    def reject(self, reason):
+        """
+        Count a rejected attempt and reset the simulation counters for the next one,
+        so they describe the accepted image while the phase times keep the time spent on the rejected ones.
+        """
+        self.rejections[reason] += 1
+        self.walkers_spawned = 0
+        self.max_depth = 0
+        self.total_moves = 0
+        self.tortuous_segments = 0
+
+    def add_time(self, phase, seconds):
+        self.phase_times[phase] = self.phase_times.get(phase, 0.0) + seconds
+
+    def to_dict(self):
+        return {
+            "walkers_spawned": self.walkers_spawned,
+            "max_depth": self.max_depth,
+            "total_moves": self.total_moves,
+            "tortuous_segments": self.tortuous_segments,
+            "pixels_painted": self.pixels_painted,
+            "attempts": int(self.accepted) + sum(self.rejections.values()),
+            "accepted": self.accepted,
+            **{f"rejected_{reason}": count for reason, count in self.rejections.items()},
+            **{f"{phase}_time": seconds for phase, seconds in self.phase_times.items()},
+        }
+
+class PhaseClock:
+    """
+    Times consecutive phases: lap(name) adds the time since the previous lap (or the creation) to the phase name,
+    less the time added to other phases of stats in between (the canvas times its own painting), so that they do not overlap.
+    Does nothing when stats is None.
+    """
+    def __init__(self, stats):
+        self.stats = stats
+        if stats is not None:
+            self.last = time.perf_counter()
+            self.timed = sum(stats.phase_times.values())
+
+    def lap(self, name):
+        if self.stats is None:
+            return
+        now = time.perf_counter()
+        self.stats.add_time(name, now - self.last - (sum(self.stats.phase_times.values()) - self.timed))
+        self.last = now
+        self.timed = sum(self.stats.phase_times.values())
@@ -0,0 +1,24 @@
+import pytest
+
+import kernels
+from generator_config import GeneratorConfig
+
+ENGINES = ["tree", "population"]
+# The default crop window, and the whole grid so that the strokes on the edge of the grid reach the window
+CROP_WINDOWS = [(0.2, 0.8), (0, 1)]
+
+@pytest.mark.parametrize("crop_window", CROP_WINDOWS)
+@pytest.mark.parametrize("engine", ENGINES)
+def test_uncompiled_kernels_match_numpy(engine, crop_window, monkeypatch):
+    # Without Numba the kernels are plain Python functions, selecting the numba backend anyway runs them as they are
+    if kernels.numba is None:
+        monkeypatch.setattr(kernels, "numba", object())
+    config = GeneratorConfig(grid_size = 400, simulation_engine = engine, crop_window = crop_window)
+    assert kernels.check_backends(range(4), config) == []
+
+@pytest.mark.parametrize("crop_window", CROP_WINDOWS)
+@pytest.mark.parametrize("engine", ENGINES)
+def test_compiled_kernels_match_numpy(engine, crop_window):
+    pytest.importorskip("numba")
+    config = GeneratorConfig(grid_size = 400, simulation_engine = engine, crop_window = crop_window)
+    assert kernels.check_backends(range(4), config) == []
@@ -0,0 +1,51 @@
+import numpy as np
+import pytest
+
+import kernels
+from canvas import Canvas, DeferredCanvas, TiledCanvas, PERPENDICULAR_ROTATIONS
+
+GRID_SIZE = 300
+WINDOWS = [(0, GRID_SIZE), (0, 100), (0, 50), (60, 240), (250, GRID_SIZE)]
+
+def random_strokes(seed, count = 2000):
+    rng = np.random.default_rng(seed)
+    centers = rng.uniform(-10, GRID_SIZE + 10, (count, 2))
+    angles = rng.uniform(0, 2 * np.pi, count)
+    directions = np.stack((np.cos(angles), np.sin(angles)), axis=-1)
+    widths = rng.uniform(0, 30, count)
+    return centers, directions, widths
+
+def reference_pixels(window, centers, directions, widths):
+    canvas = Canvas(GRID_SIZE, window)
+    for center, direction, width in zip(centers, directions, widths):
+        canvas.paint_perpendicular(center, direction, width)
+    return canvas.pixels
+
+@pytest.mark.parametrize("window", WINDOWS)
+def test_stamp_perpendicular_matches_reference_painter(window):
+    strokes = random_strokes(sum(window))
+    expected = reference_pixels(window, *strokes)
+
+    canvas = Canvas(GRID_SIZE, window)
+    canvas.stamp_perpendicular(*strokes)
+    assert np.array_equal(canvas.pixels, expected)
+
+    tiled = TiledCanvas(GRID_SIZE, window, tile_size = 64)
+    tiled.stamp_perpendicular(*strokes)
+    assert np.array_equal(tiled.pixels, expected)
+
+    # The kernel of the numba backend, run as a plain Python function when Numba is missing
+    pixels = np.zeros_like(expected)
+    kernels.stamp_perpendicular_kernel(pixels, window[0], window[1], GRID_SIZE, *strokes, PERPENDICULAR_ROTATIONS)
+    assert np.array_equal(pixels, expected)
+
+def test_deferred_canvas_paints_on_paint():
+    centers, directions, widths = random_strokes(0)
+    expected = reference_pixels((60, 240), centers, directions, widths)
+
+    deferred = DeferredCanvas(Canvas(GRID_SIZE, (60, 240)))
+    deferred.stamp_perpendicular(centers[:1000], directions[:1000], widths[:1000])
+    for center, direction, width in zip(centers[1000:], directions[1000:], widths[1000:]):
+        deferred.paint_perpendicular(center, direction, width)
+    assert not deferred.canvas.pixels.any()
+    assert np.array_equal(deferred.paint().pixels, expected)
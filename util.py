@@ -1,16 +1,21 @@
 import numpy as np
 
-def generate_centered_point(grid_size):
+def generate_centered_point(grid_size, rng):
     # generate point thats not too in the center and not too close to the edges
     start = int(grid_size * 0.25)
     end = int(grid_size * 0.40)
     x = list(range(start, end)) + list(range(grid_size - end, grid_size - start))
 
     return (
-        np.random.choice(x),
-        np.random.choice(x)
+        rng.choice(x),
+        rng.choice(x)
     )
 
+def crop_window(grid_size, window):
+    # (start, end) fractions of the grid -> [start_index, end_index) pixel range
+    start, end = window
+    return int(grid_size * start), int(grid_size * end)
+
 def bound(grid_size, x):
     if x < 0:
         return 0
@@ -0,0 +1,179 @@
+import argparse
+import numpy as np
+
+from config import GRID_SIZE, SINK_STRENGTH, VECTOR_FIELD_WEIGHT, MIDDLE_LINE_WEIGHT, VECTOR_FIELD_RESOLUTION
+
+def E(q, r0, x, y):
+    """Return the electric field vector E=(Ex,Ey) due to charge q at r0."""
+    den = np.hypot(x-r0[0], y-r0[1])**3
+    return q * (x - r0[0]) / den, q * (y - r0[1]) / den
+
+def normalize_vectors(x, y):
+    """Normalize arrays of vectors. Zero length (undefined) vectors become (0, 0)."""
+    with np.errstate(divide="ignore", invalid="ignore"):
+        norm = np.sqrt(x ** 2 + y ** 2)
+        x, y = x / norm, y / norm
+    undefined = ~(np.isfinite(x) & np.isfinite(y))
+    x[undefined] = 0
+    y[undefined] = 0
+    return x, y
+
+def static_directions(
+        source_point,
+        grid_size,
+        x,
+        y,
+        sink_strength = SINK_STRENGTH,
+        vector_field_weight = VECTOR_FIELD_WEIGHT,
+        middle_line_weight = MIDDLE_LINE_WEIGHT
+    ):
+    """
+    The part of Walker.get_direction that does not depend on the walker:
+    the weighted vector field direction plus the weighted middle line direction, evaluated at arrays of points.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    source_x, source_y = source_point
+    sink_x, sink_y = (grid_size - source_x, grid_size - source_y)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ex, ey = E(1, (source_x, source_y), x, y)
+        ex_, ey_ = E(-1 * sink_strength, (sink_x, sink_y), x, y)
+    field_x, field_y = normalize_vectors(ex + ex_, ey + ey_)
+
+    mid_x = (source_x + sink_x) / 2
+    mid_y = (source_y + sink_y) / 2
+    line_x, line_y = normalize_vectors(mid_x - x, mid_y - y)
+
+    return (
+        field_x * vector_field_weight + line_x * middle_line_weight,
+        field_y * vector_field_weight + line_y * middle_line_weight
+    )
+
+class VectorField:
+    """
+    Per image lookup table for the static part of Walker.get_direction.
+    The field only depends on the source point, the sink strength and the grid,
+    so it is tabulated once on a grid with `resolution` pixel spacing and bilinearly interpolated at each step.
+    """
+    def __init__(
+            self,
+            source_point,
+            grid_size,
+            resolution = VECTOR_FIELD_RESOLUTION,
+            sink_strength = SINK_STRENGTH,
+            vector_field_weight = VECTOR_FIELD_WEIGHT,
+            middle_line_weight = MIDDLE_LINE_WEIGHT
+        ):
+        self.source_point = source_point
+        self.grid_size = grid_size
+        self.resolution = resolution
+        self.momentum_weight = 1 - vector_field_weight - middle_line_weight
+
+        nodes = np.arange(0, grid_size + resolution, resolution, dtype=np.float64)
+        X, Y = np.meshgrid(nodes, nodes, indexing="ij")
+        table_x, table_y = static_directions(
+            source_point, grid_size, X, Y,
+            sink_strength = sink_strength,
+            vector_field_weight = vector_field_weight,
+            middle_line_weight = middle_line_weight
+        )
+        self.table = np.stack((table_x, table_y), axis=-1)
+        self.size = len(nodes)
+        # Plain python lists are much faster than numpy for indexing single elements
+        self._table_x = table_x.tolist()
+        self._table_y = table_y.tolist()
+
+    def lookup(self, x, y):
+        """Bilinearly interpolated static direction at (x, y)."""
+        fx = x / self.resolution
+        fy = y / self.resolution
+        i = min(max(int(fx), 0), self.size - 2)
+        j = min(max(int(fy), 0), self.size - 2)
+        tx = fx - i
+        ty = fy - j
+
+        row_x, next_row_x = self._table_x[i], self._table_x[i + 1]
+        row_y, next_row_y = self._table_y[i], self._table_y[i + 1]
+
+        w_a = (1 - tx) * (1 - ty)
+        w_b = tx * (1 - ty)
+        w_c = (1 - tx) * ty
+        w_d = tx * ty
+        return (
+            row_x[j] * w_a + next_row_x[j] * w_b + row_x[j + 1] * w_c + next_row_x[j + 1] * w_d,
+            row_y[j] * w_a + next_row_y[j] * w_b + row_y[j + 1] * w_c + next_row_y[j + 1] * w_d
+        )
+
+    def lookup_many(self, x, y):
+        """Vectorized lookup over arrays of points."""
+        fx = np.asarray(x) / self.resolution
+        fy = np.asarray(y) / self.resolution
+        i = np.clip(fx.astype(np.int64), 0, self.size - 2)
+        j = np.clip(fy.astype(np.int64), 0, self.size - 2)
+        tx = (fx - i)[..., None]
+        ty = (fy - j)[..., None]
+
+        table = self.table
+        interpolated = (
+            table[i, j] * ((1 - tx) * (1 - ty)) +
+            table[i + 1, j] * (tx * (1 - ty)) +
+            table[i, j + 1] * ((1 - tx) * ty) +
+            table[i + 1, j + 1] * (tx * ty)
+        )
+        return interpolated[..., 0], interpolated[..., 1]
+
+    def direction(self, point, current_direction):
+        """Walker direction at point, same weighting as the exact Walker.get_direction."""
+        static_x, static_y = self.lookup(*point)
+        x = static_x + current_direction[0] * self.momentum_weight
+        y = static_y + current_direction[1] * self.momentum_weight
+        norm = (x * x + y * y) ** 0.5
+        return (x / norm, y / norm)
+
+def accuracy_report(source_point, grid_size = GRID_SIZE, resolution = VECTOR_FIELD_RESOLUTION, num_samples = 100000, seed = 0):
+    """
+    Compare the tabulated walker directions against the exact field at random points with random walker directions.
+    Returns the angular error statistics in degrees.
+    """
+    rng = np.random.default_rng(seed)
+    field = VectorField(source_point, grid_size, resolution)
+
+    x = rng.uniform(0, grid_size - 1, num_samples)
+    y = rng.uniform(0, grid_size - 1, num_samples)
+    angles = rng.uniform(0, 2 * np.pi, num_samples)
+    direction_x, direction_y = np.cos(angles), np.sin(angles)
+
+    exact_x, exact_y = static_directions(source_point, grid_size, x, y)
+    exact_x, exact_y = normalize_vectors(exact_x + direction_x * field.momentum_weight, exact_y + direction_y * field.momentum_weight)
+
+    tabulated = np.array([field.direction((px, py), (dx, dy)) for px, py, dx, dy in zip(x, y, direction_x, direction_y)])
+    dot = np.clip(exact_x * tabulated[:, 0] + exact_y * tabulated[:, 1], -1, 1)
+    errors = np.degrees(np.arccos(dot))
+
+    return {
+        "source_point": tuple(int(v) for v in source_point),
+        "grid_size": grid_size,
+        "resolution": resolution,
+        "num_samples": num_samples,
+        "mean_error_degrees": float(errors.mean()),
+        "p99_error_degrees": float(np.percentile(errors, 99)),
+        "max_error_degrees": float(errors.max()),
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Accuracy of the tabulated vector field against the exact field")
+    parser.add_argument("--grid-size", type=int, default=GRID_SIZE)
+    parser.add_argument("--resolutions", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--samples", type=int, default=100000)
+    args = parser.parse_args()
+
+    for source_point in [(int(args.grid_size * 0.3), int(args.grid_size * 0.35)), (int(args.grid_size * 0.7), int(args.grid_size * 0.28))]:
+        for resolution in args.resolutions:
+            report = accuracy_report(source_point, args.grid_size, resolution, args.samples)
+            print(
+                f"source={report['source_point']} resolution={resolution}: "
+                f"mean={report['mean_error_degrees']:.5f} "
+                f"p99={report['p99_error_degrees']:.5f} "
+                f"max={report['max_error_degrees']:.5f} degrees"
+            )
@@ -3,10 +3,7 @@ import numpy as np
 import matplotlib.pyplot as plt
 from matplotlib.patches import Circle
 
-def E(q, r0, x, y):
-    """Return the electric field vector E=(Ex,Ey) due to charge q at r0."""
-    den = np.hypot(x-r0[0], y-r0[1])**3
-    return q * (x - r0[0]) / den, q * (y - r0[1]) / den
+from vector_field import E, normalize_vectors
 
 # Grid of x, y points
 def generate_vector_field(source_point, nx, ny):
@@ -27,17 +24,8 @@ def generate_vector_field(source_point, nx, ny):
         Ex += ex
         Ey += ey
 
-    # Combine Ex and Ey as pair of coordinates
-    Ec = np.stack((Ex, Ey), axis=-1)
-
-    # Normalize the length of each arrow
-    for i in range(len(Ec)):
-        for j in range(len(Ec[i])):
-            dx, dy = Ec[i][j]
-            norm = np.sqrt(dx**2 + dy**2)
-            Ec[i][j] = [dx/norm, dy/norm]
-
-    Ec = np.array(Ec)
+    # Normalize the length of each arrow and combine them as pair of coordinates
+    Ec = np.stack(normalize_vectors(Ex, Ey), axis=-1)
     return x, y, charges, Ex, Ey, Ec
     # return Ec
 
@@ -0,0 +1,258 @@
+import os
+import csv
+import json
+import time
+import zlib
+import queue
+import struct
+import threading
+import numpy as np
+import pandas as pd
+
+MANIFEST_COLUMNS = ["filename", "tortuous", "tortuous_points"]
+
+def atomic_write(filename, write):
+    """
+    Call write(temporary_filename) and move the result to filename in one step,
+    so a crash never leaves a half written file behind under the final name.
+    """
+    directory, name = os.path.split(filename)
+    temporary_filename = os.path.join(directory, f".{name}.tmp")
+    write(temporary_filename)
+    os.replace(temporary_filename, filename)
+
+# Pillow's default zlib level, 0 (no compression) to 9 (smallest files)
+PNG_COMPRESS_LEVEL = 6
+
+def save_image(img, filename, compress_level = PNG_COMPRESS_LEVEL):
+    atomic_write(filename, lambda path: img.save(path, format="PNG", compress_level=compress_level))
+
+def write_png(fp, width, height, channels, strips, compress_level = PNG_COMPRESS_LEVEL):
+    """
+    Stream a PNG to the binary file fp from strips of rows: uint8 arrays of shape (rows, width) or (rows, width, 3),
+    top to bottom, so that the whole image never has to be in memory. channels is 1 (grayscale) or 3 (RGB).
+    """
+    def write_chunk(kind, data):
+        fp.write(struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data)))
+
+    fp.write(b"\x89PNG\r\n\x1a\n")
+    write_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 0 if channels == 1 else 2, 0, 0, 0))
+    compressor = zlib.compressobj(compress_level)
+    for strip in strips:
+        rows = strip.reshape(len(strip), width * channels)
+        # Every row starts with its filter type, 0 (none)
+        data = np.concatenate((np.zeros((len(rows), 1), dtype=np.uint8), rows), axis=1).tobytes()
+        compressed = compressor.compress(data)
+        if compressed:
+            write_chunk(b"IDAT", compressed)
+    write_chunk(b"IDAT", compressor.flush())
+    write_chunk(b"IEND", b"")
+
+def write_run_info(directory, info):
+    def write(path):
+        with open(path, "w") as f:
+            json.dump(info, f)
+    atomic_write(os.path.join(directory, "run.json"), write)
+
+def run_finished(directory):
+    """Whether the run in directory was finalized (data.csv written and no partial manifest left)."""
+    return os.path.exists(os.path.join(directory, "data.csv")) and \
+        not os.path.exists(os.path.join(directory, "data.partial.csv"))
+
+class ManifestWriter:
+    """
+    Streams the manifest of a run to disk while the images are generated.
+
+    Each row is appended to `data.partial.csv` (with the global index of its image) as soon as the image has been written,
+    so a crashed or pre-empted run loses at most the images in flight and can be resumed.
+    finalize() sorts the rows by index and writes `data.csv`, the same file a single pass run writes.
+    """
+    def __init__(self, directory, columns = MANIFEST_COLUMNS, resume = False):
+        self.directory = directory
+        self.columns = columns
+        self.path = os.path.join(directory, "data.partial.csv")
+        self.final_path = os.path.join(directory, "data.csv")
+
+        if resume and os.path.exists(self.path):
+            self._drop_incomplete_row()
+            new_file = os.path.getsize(self.path) == 0
+        else:
+            new_file = True
+        self.file = open(self.path, "a" if resume else "w", newline="")
+        self.writer = csv.writer(self.file, delimiter="\t", lineterminator="\n")
+        if new_file:
+            self.writer.writerow(["index"] + self.columns)
+            self.file.flush()
+
+    def _drop_incomplete_row(self):
+        # A crash while appending can leave a partial last line behind
+        with open(self.path, "rb+") as f:
+            content = f.read()
+            if content and not content.endswith(b"\n"):
+                f.truncate(content.rfind(b"\n") + 1)
+
+    def finished_indices(self):
+        """Indices whose row (and therefore image) has already been written."""
+        df = pd.read_csv(self.path, sep="\t", usecols=["index", "filename"])
+        return {
+            index for index, filename in zip(df["index"], df["filename"])
+            if os.path.exists(filename)
+        }
+
+    def write_run_info(self, info):
+        write_run_info(self.directory, info)
+
+    @staticmethod
+    def read_run_info(directory):
+        run_path = os.path.join(directory, "run.json")
+        if not os.path.exists(run_path):
+            return None
+        with open(run_path) as f:
+            return json.load(f)
+
+    def append(self, index, record):
+        self.writer.writerow([index] + [record[column] for column in self.columns])
+        self.file.flush()
+
+    def finalize(self, keep_index = False):
+        """keep_index keeps the global index column in data.csv (the partial manifests of sharded runs need it to be merged)."""
+        self.file.close()
+        df = pd.read_csv(self.path, sep="\t", keep_default_na=False)
+        # Resumed runs can have duplicated rows for an index, keep the last one
+        df = df.drop_duplicates(subset="index", keep="last").sort_values("index")
+        columns = ["index"] + self.columns if keep_index else self.columns
+        atomic_write(self.final_path, lambda path: df[columns].to_csv(path, index=False, sep="\t"))
+        os.remove(self.path)
+
+class BackgroundWriter:
+    """
+    Pool of threads encoding and saving PNGs while the caller goes on generating (zlib and file I/O release the GIL).
+
+    submit(files, result) queues a job: the (image, filename) pairs to save, and anything to get back once they are saved.
+    At most max_pending jobs wait in the queue, submit blocks beyond that so that unsaved images do not pile up in memory.
+    completed() returns the (result, seconds spent saving) of the jobs finished since the last call,
+    close() waits for the remaining jobs and returns theirs. The first error of a writer thread is raised
+    by the next submit, completed or close call.
+    """
+    def __init__(self, threads = 4, max_pending = None, compress_level = PNG_COMPRESS_LEVEL):
+        self.compress_level = compress_level
+        self.jobs = queue.Queue(maxsize=max_pending if max_pending is not None else threads * 2)
+        self.lock = threading.Lock()
+        self.done = []
+        self.error = None
+        self.threads = [threading.Thread(target=self._work, daemon=True) for _ in range(threads)]
+        for thread in self.threads:
+            thread.start()
+
+    def _work(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            files, result = job
+            # After an error the remaining jobs are dropped, the caller gets the error instead
+            if self.error is not None:
+                continue
+            try:
+                start = time.perf_counter()
+                for img, filename in files:
+                    save_image(img, filename, self.compress_level)
+                seconds = time.perf_counter() - start
+            except Exception as error:
+                with self.lock:
+                    if self.error is None:
+                        self.error = error
+                continue
+            with self.lock:
+                self.done.append((result, seconds))
+
+    def _raise_error(self):
+        if self.error is not None:
+            raise self.error
+
+    def submit(self, files, result = None):
+        self._raise_error()
+        self.jobs.put((files, result))
+
+    def completed(self):
+        self._raise_error()
+        with self.lock:
+            done, self.done = self.done, []
+        return done
+
+    def close(self):
+        for _ in self.threads:
+            self.jobs.put(None)
+        for thread in self.threads:
+            thread.join()
+        return self.completed()
+
+# Memory maps of the shards opened by this process. The ShardWriter is sent along with every task,
+# so the maps are kept here for the whole life of the worker process instead of in the writer
+open_shards = {}
+
+class ShardWriter:
+    """
+    Writes single channel images into fixed size memory-mapped .npy shards instead of one PNG per image.
+
+    Shard k is `shard_<k>.npy`, an array of shape (shard_size, height, width) holding the images with global indices
+    [k * shard_size, (k + 1) * shard_size). Every image has a fixed slot, so the workers write their images without
+    any coordination, and the shards can be read back zero-copy with load_sharded_image.
+    """
+    def __init__(self, directory, shard_size, image_shape):
+        self.directory = directory
+        self.shard_size = shard_size
+        self.image_shape = tuple(image_shape)
+
+    def shard_filename(self, index):
+        return os.path.join(self.directory, f"shard_{index // self.shard_size:05d}.npy")
+
+    def create_shards(self, num_images, indices = None):
+        """
+        Create the (sparse) shard files of a run, keeping the ones that already exist.
+        indices: range of the global indices that will be written, only the shards holding them are created. All by default.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        if indices is None:
+            indices = range(num_images)
+        for first_index in range(0, num_images, self.shard_size):
+            if first_index + self.shard_size <= indices.start or first_index >= indices.stop:
+                continue
+            filename = self.shard_filename(first_index)
+            if not os.path.exists(filename):
+                # A map left open by an earlier run of this process would point to a deleted file
+                open_shards.pop(filename, None)
+                shape = (min(self.shard_size, num_images - first_index),) + self.image_shape
+                def write(path):
+                    np.lib.format.open_memmap(path, mode="w+", dtype=np.uint8, shape=shape).flush()
+                atomic_write(filename, write)
+
+    def write(self, index, pixels):
+        """
+        Write the image at global index, returns its (shard filename, offset in the shard).
+        The image is in the page cache of the shared mapping once this returns, so it survives the process being
+        killed without a flush per image. Only a crash of the machine before close() can lose images.
+        """
+        filename = self.shard_filename(index)
+        shard = open_shards.get(filename)
+        if shard is None:
+            shard = open_shards[filename] = np.load(filename, mmap_mode="r+")
+        offset = index % self.shard_size
+        shard[offset] = pixels
+        return filename, offset
+
+    def close(self):
+        """
+        End of the run: drop the memory maps of this process and sync every shard file to disk,
+        which also covers the images written through the maps of the worker processes.
+        """
+        for filename in [filename for filename in open_shards if os.path.dirname(filename) == self.directory]:
+            open_shards.pop(filename).flush()
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".npy"):
+                with open(entry.path, "rb+") as f:
+                    os.fsync(f.fileno())
+
+def load_sharded_image(filename, offset):
+    """Zero-copy view of an image written by ShardWriter."""
+    return np.load(filename, mmap_mode="r")[offset]